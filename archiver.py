@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import time
+import zlib
+import shutil
+import struct
+import tarfile
+import collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+CHUNK_SIZE = 1024 * 1024
+
+
+class Archiver:
+    """Packs a build folder into one file. Zip members are compressed in parallel, already compressed files are stored as is"""
+    def __init__(self, format_="zip", level=6, workers=0, store_extensions=()):
+        if format_ == "tar.zst" and zstandard is None:
+            print("zstandard module is not installed, archiving builds as zip")
+            format_ = "zip"
+        if format_ not in ("zip", "tar.zst"):
+            raise Exception("Unknown archive format %s" % format_)
+        self.format = format_
+        self.level = level
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.store_extensions = set(e.lower().lstrip(".") for e in store_extensions)
+
+    def make_archive(self, base_name, root_dir):
+        """Archives the contents of `root_dir` to `base_name` plus the format's extension, returns the archive path"""
+        if self.format == "tar.zst":
+            return self.make_tar_zst(base_name + ".tar.zst", root_dir)
+        return self.make_zip(base_name + ".zip", root_dir)
+
+    def make_tar_zst(self, path, root_dir):
+        #zstd spreads one stream over its own threads, so tar can stay sequential
+        compressor = zstandard.ZstdCompressor(level=self.level, threads=self.workers)
+        with open(path, "wb") as f:
+            with compressor.stream_writer(f) as stream:
+                with tarfile.open(fileobj=stream, mode="w|") as tar:
+                    for name in sorted(os.listdir(root_dir)):
+                        tar.add(os.path.join(root_dir, name), arcname=name)
+        return path
+
+    def make_zip(self, path, root_dir):
+        entries = list_entries(root_dir)
+        parts_dir = path + ".parts"
+        if os.path.isdir(parts_dir):
+            shutil.rmtree(parts_dir)
+        os.makedirs(parts_dir)
+
+        try:
+            with open(path, "wb") as f, ThreadPoolExecutor(self.workers) as executor:
+                writer = ZipWriter(f)
+                pending = collections.deque()
+                for index, (file_path, name) in enumerate(entries):
+                    if file_path is None:
+                        pending.append((name, None, None))
+                    else:
+                        part_path = os.path.join(parts_dir, str(index))
+                        pending.append((name, file_path, executor.submit(self.compress, file_path, part_path)))
+                    #members are written in order, keep a bounded window of them in flight
+                    while len(pending) > self.workers * 2:
+                        self.write_member(writer, *pending.popleft())
+                while len(pending) > 0:
+                    self.write_member(writer, *pending.popleft())
+                writer.close()
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        return path
+
+    def compress(self, file_path, part_path):
+        """Returns (method, crc, compressed size, size, path of the data to copy)"""
+        extension = os.path.splitext(file_path)[1].lower().lstrip(".")
+        crc = 0
+        size = 0
+        if extension in self.store_extensions or self.level == 0:
+            with open(file_path, "rb") as src:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+            return ZIP_STORED, crc, size, size, file_path
+
+        #zlib releases the GIL, so threads compress on all cores
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        with open(file_path, "rb") as src, open(part_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                dst.write(compressor.compress(chunk))
+            dst.write(compressor.flush())
+            compressed_size = dst.tell()
+        return ZIP_DEFLATED, crc, compressed_size, size, part_path
+
+    def write_member(self, writer, name, file_path, future):
+        if future is None:
+            writer.add_directory(name)
+            return
+        method, crc, compressed_size, size, data_path = future.result()
+        writer.add(name, os.stat(file_path), method, crc, compressed_size, size, data_path)
+        if data_path != file_path:
+            os.remove(data_path)
+
+
+class ZipWriter:
+    """Writes zip members whose data is already compressed, with zip64 records where sizes need them"""
+    def __init__(self, f):
+        self.f = f
+        self.central = []
+        self.count = 0
+
+    def add_directory(self, name):
+        self._write(name, 0o40775 << 16 | 0x10, time.time(), ZIP_STORED, 0, 0, 0, None)
+
+    def add(self, name, st, method, crc, compressed_size, size, data_path):
+        self._write(name, (st.st_mode & 0xFFFF) << 16, st.st_mtime, method, crc, compressed_size, size, data_path)
+
+    def _write(self, name, external_attr, mtime, method, crc, compressed_size, size, data_path):
+        encoded = name.encode("utf-8")
+        flags = 0 if len(encoded) == len(name) else 0x800
+        dos_time, dos_date = get_dos_time(mtime)
+        offset = self.f.tell()
+
+        zip64 = compressed_size >= ZIP64_LIMIT or size >= ZIP64_LIMIT
+        extract_version = 45 if zip64 else (20 if method == ZIP_DEFLATED or name.endswith("/") else 10)
+        extra = struct.pack("<HHQQ", 1, 16, size, compressed_size) if zip64 else b""
+        self.f.write(struct.pack("<4s2B4HL2L2H", b"PK\003\004", extract_version, 0, flags, method, dos_time, dos_date, crc, \
+            ZIP64_LIMIT if zip64 else compressed_size, ZIP64_LIMIT if zip64 else size, len(encoded), len(extra)))
+        self.f.write(encoded)
+        self.f.write(extra)
+        if data_path is not None:
+            with open(data_path, "rb") as src:
+                shutil.copyfileobj(src, self.f, CHUNK_SIZE)
+
+        #central directory records are small, keep them until the end
+        fields = []
+        if size >= ZIP64_LIMIT:
+            fields.append(size)
+        if compressed_size >= ZIP64_LIMIT:
+            fields.append(compressed_size)
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+        extra = struct.pack("<HH%dQ" % len(fields), 1, 8 * len(fields), *fields) if len(fields) > 0 else b""
+        if len(fields) > 0:
+            extract_version = 45
+        create_system = 0 if os.name == "nt" else 3
+        self.central.append(struct.pack("<4s4B4HL2L5H2L", b"PK\001\002", 45, create_system, extract_version, 0, flags, method, \
+            dos_time, dos_date, crc, min(compressed_size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(encoded), len(extra), 0, 0, 0, \
+            external_attr, min(offset, ZIP64_LIMIT)) + encoded + extra)
+        self.count += 1
+
+    def close(self):
+        start = self.f.tell()
+        for record in self.central:
+            self.f.write(record)
+        end = self.f.tell()
+        size = end - start
+
+        if self.count >= 0xFFFF or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            self.f.write(struct.pack("<4sQ2H2L4Q", b"PK\006\006", 44, 45, 45, 0, 0, self.count, self.count, size, start))
+            self.f.write(struct.pack("<4sLQL", b"PK\006\007", 0, end, 1))
+        self.f.write(struct.pack("<4s4H2LH", b"PK\005\006", 0, 0, min(self.count, 0xFFFF), min(self.count, 0xFFFF), \
+            min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0))
+
+
+def list_entries(root_dir):
+    """Returns (file path, archive name) pairs like shutil.make_archive would store them, directories have no file path"""
+    entries = []
+    for root, dirs, files in os.walk(root_dir):
+        dirs.sort()
+        rel = os.path.relpath(root, root_dir)
+        prefix = "" if rel == os.curdir else rel.replace(os.sep, "/") + "/"
+        if len(prefix) > 0:
+            entries.append((None, prefix))
+        for name in sorted(files):
+            entries.append((os.path.join(root, name), prefix + name))
+    return entries
+
+
+def get_dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        t = time.localtime(315532800)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
@@ -0,0 +1,154 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+
+import os
+import re
+import hmac
+import time
+import socket
+import hashlib
+import binascii
+import threading
+
+
+class ArtifactServer:
+    """Serves files under `root` over HTTP to whoever holds a signed, expiring link"""
+    def __init__(self, root, host, port, public_url, link_ttl_hours):
+        self.root = os.path.realpath(root)
+        self.host = host
+        self.port = port
+        self.public_url = public_url.rstrip("/") if public_url else "http://%s:%d" % (socket.getfqdn(), port)
+        self.link_ttl = link_ttl_hours * 3600
+        self.secret = None
+        self.httpd = None
+
+    def is_enabled(self):
+        return self.port > 0
+
+    def start(self):
+        self.secret = self.load_secret()
+        server = self
+
+        class Handler(ArtifactRequestHandler):
+            artifact_server = server
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        #request threads must not keep Gaben from exiting
+        self.httpd.daemon_threads = True
+        thread = threading.Thread(target=self.httpd.serve_forever, name="artifact-server")
+        thread.daemon = True
+        thread.start()
+        print("Artifact server is listening on %s:%d" % (self.host, self.port))
+
+    def load_secret(self):
+        #kept on disk so links stay valid after a restart
+        path = os.path.join(self.root, "artifact_server.key")
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                return binascii.unhexlify(f.read().strip())
+        secret = os.urandom(32)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(binascii.hexlify(secret).decode("ascii"))
+        return secret
+
+    def get_link(self, path):
+        """Returns a download link for `path`, or None if the server is off or the file is outside of root"""
+        if self.httpd is None:
+            return None
+        rel = os.path.relpath(os.path.realpath(path), self.root)
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            return None
+        rel = rel.replace(os.sep, "/")
+        expires = int(time.time() + self.link_ttl)
+        return "%s/%s?expires=%d&signature=%s" % (self.public_url, quote(rel), expires, self.sign(rel, expires))
+
+    def sign(self, rel, expires):
+        message = ("%s:%d" % (rel, expires)).encode("utf-8")
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def resolve(self, rel, expires, signature):
+        """Returns the local path for a valid link or None"""
+        try:
+            expires = int(expires)
+        except ValueError:
+            return None
+        if expires < time.time() or not hmac.compare_digest(self.sign(rel, expires), signature):
+            return None
+        path = os.path.realpath(os.path.join(self.root, *rel.split("/")))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+
+class ArtifactRequestHandler(BaseHTTPRequestHandler):
+    artifact_server = None
+    RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def serve(self, send_body):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        rel = unquote(url.path.lstrip("/"))
+        path = self.artifact_server.resolve(rel, query.get("expires", [""])[0], query.get("signature", [""])[0])
+        if path is None:
+            self.send_error(404, "Link is invalid or expired")
+            return
+
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            status = 200
+
+            header = self.headers.get("Range")
+            if header is not None:
+                span = self.parse_range(header, size)
+                if span is None:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start, end = span
+                status = 206
+
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Disposition", "attachment; filename=\"%s\"" % os.path.basename(path))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(length))
+            if status == 206:
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            self.end_headers()
+
+            if send_body and length > 0:
+                self.wfile.flush()
+                #sendfile copies straight from the page cache to the socket where the OS supports it
+                self.connection.sendfile(f, start, length)
+
+    def parse_range(self, header, size):
+        #single ranges only, that's what download managers use to resume
+        match = self.RANGE.match(header.strip())
+        if match is None or match.group(1) == match.group(2) == "":
+            return None
+        if match.group(1) == "":
+            suffix = int(match.group(2))
+            if suffix == 0:
+                return None
+            return max(0, size - suffix), size - 1
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) != "" else size - 1
+        if start >= size or end < start:
+            return None
+        return start, min(end, size - 1)
+
+    def log_message(self, format, *args):
+        print("Artifact server: %s - %s" % (self.address_string(), format % args))
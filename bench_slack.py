@@ -0,0 +1,102 @@
+"""Micro-benchmark of Web API call latency against a local HTTPS stand-in of Slack: the pooled
+SlackRequest session against a new connection per call, like requests.post made before
+
+    python bench_slack.py [calls]
+
+Needs the openssl command to make a throwaway certificate.
+"""
+import os
+import ssl
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from slackclient.slackrequest import SlackRequest
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    #headers and body go out in separate writes, without this every reply waits on a delayed ACK
+    disable_nagle_algorithm = True
+    rate_limited = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if StandInHandler.rate_limited > 0:
+            StandInHandler.rate_limited -= 1
+            self.reply(429, b'{"ok":false,"error":"ratelimited"}', {"Retry-After": "1"})
+            return
+        self.reply(200, b'{"ok":true}')
+
+    def reply(self, code, body, headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(directory):
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost", \
+        "-addext", "subjectAltName=DNS:localhost", \
+        "-keyout", key, "-out", cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    httpd = ThreadingHTTPServer(("localhost", 0), StandInHandler)
+    httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    thread = threading.Thread(target=httpd.serve_forever, name="slack-stand-in")
+    thread.daemon = True
+    thread.start()
+    return httpd, cert
+
+
+def measure(call, count):
+    started = time.perf_counter()
+    for i in range(count):
+        response = call()
+        if response.status_code != 200:
+            raise Exception("Stand-in answered HTTP %d" % response.status_code)
+    return (time.perf_counter() - started) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    directory = tempfile.mkdtemp()
+    try:
+        httpd, cert = start_stand_in(directory)
+        #both clients trust the throwaway certificate through the environment
+        os.environ["REQUESTS_CA_BUNDLE"] = cert
+        base_url = "https://localhost:%d/api/" % httpd.server_address[1]
+        api = SlackRequest(base_url=base_url)
+        headers = {"user-agent": api.get_user_agent(), "Authorization": "Bearer xoxb-bench"}
+
+        fresh = measure(lambda: requests.post(base_url + "auth.test", headers=headers, data={"a": "b"}), count)
+        pooled = measure(lambda: api.do("xoxb-bench", "auth.test", {"a": "b"}), count)
+        print("%d calls to %s" % (count, base_url))
+        print("new connection: %6.2f ms/call" % fresh)
+        print("pooled:         %6.2f ms/call (%.1fx)" % (pooled, fresh / pooled))
+
+        StandInHandler.rate_limited = 1
+        started = time.perf_counter()
+        response = api.do("xoxb-bench", "auth.test")
+        print("rate limited once: HTTP %d after %.1f s" % (response.status_code, time.perf_counter() - started))
+        httpd.shutdown()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
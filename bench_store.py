@@ -0,0 +1,73 @@
+"""Micro-benchmark of project lookups: the indexed Store.search against the old linear scan
+
+    python bench_store.py [projects] [lookups]
+"""
+import sys
+import time
+import random
+
+from store import Project, Store
+
+
+class MemoryBackend:
+    def load(self):
+        return []
+
+    def upsert(self, project, projects):
+        pass
+
+    def delete(self, project, projects):
+        pass
+
+
+def linear_search(data, sentence):
+    #Store.search before the index was added
+    projects = []
+    for value in data:
+        if value.name.lower().find(sentence.lower()) >= 0 and value not in projects:
+            projects.append(value)
+        if value.url.lower().find(sentence.lower()) >= 0 and value not in projects:
+            projects.append(value)
+    if len(projects) > 1:
+        raise Exception("Ambiguous name detected")
+    if len(projects) == 0:
+        raise Exception("Project not found")
+    return projects[0]
+
+
+def measure(search, queries):
+    started = time.perf_counter()
+    for query in queries:
+        try:
+            search(query)
+        except Exception:
+            pass
+    return (time.perf_counter() - started) / len(queries) * 1000000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rnd = random.Random(1)
+    words = ["space", "tower", "puzzle", "racer", "farm", "zombie", "merge", "idle", "arena", "hero", "block", "city"]
+
+    store = Store(MemoryBackend())
+    for i in range(count):
+        name = "%s%s%d" % (rnd.choice(words), rnd.choice(words).capitalize(), i)
+        store.add_project(Project("git@git.example.com:studio%d/%s.git" % (i % 7, name), "", "", "", ""))
+    data = store.get_data()
+
+    names = [p.name for p in data]
+    queries = [rnd.choice(names) for _ in range(lookups // 2)]
+    queries += [rnd.choice(names)[:-1] for _ in range(lookups // 4)]
+    queries += [rnd.choice(words) for _ in range(lookups // 4)]
+
+    linear = measure(lambda q: linear_search(data, q), queries)
+    indexed = measure(store.search, queries)
+    print("%d projects, %d lookups" % (count, len(queries)))
+    print("linear:  %8.1f us/lookup" % linear)
+    print("indexed: %8.1f us/lookup (%.1fx)" % (indexed, linear / indexed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,16 @@
-from subprocess import call, check_output, PIPE, Popen
+from subprocess import call, check_output, PIPE, Popen, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
+from journal import BuildJournal
+from cache import ArtifactCache, LibraryCache, link_or_copy
+from archiver import Archiver
+from metrics import Metrics
+from history import BuildHistory
 
 import os
+import collections
+import signal
+import subprocess
+import uuid
 import traceback
 import sys
 import config
@@ -8,27 +18,242 @@ import hashlib
 import threading
 import shutil
 import zipfile
+import re
+import time
 
 class Builder():
-    def __init__(self, rep_directory):
+    def __init__(self, rep_directory, progress_callback=None):
         self.rep_directory = rep_directory
+        self.progress_callback = progress_callback
         self.project_builds = []
+        self.queue = []
+        self.queue_counter = 0
+        self.unity_slots = {}
+        self.mirror_locks = {}
+        self.mirror_fetched = {}
+        self.lock = threading.RLock()
+        self.journal = BuildJournal(os.path.join(rep_directory, "journal.log"))
+        self.artifact_cache = ArtifactCache(os.path.join(rep_directory, "artifact_cache"), config.ARTIFACT_CACHE_SIZE_MB)
+        self.library_cache = LibraryCache(os.path.join(rep_directory, "library_cache"), config.LIBRARY_CACHE_SIZE_MB, \
+            config.LIBRARY_CACHE_MAX_AGE_DAYS, config.LIBRARY_CACHE_REFRESH_HOURS)
+        self.metrics = Metrics()
+        self.history = BuildHistory(os.path.join(rep_directory, "history.db"))
+        self.archiver = Archiver(config.ARCHIVE_FORMAT, config.ARCHIVE_COMPRESSION_LEVEL, config.ARCHIVE_WORKERS, config.ARCHIVE_STORE_EXTENSIONS)
+        self.deliveries_dir = os.path.abspath(os.path.join(rep_directory, "deliveries"))
+        self.deliveries = {}
+        self.clean_deliveries()
 
 
     def get_jobs(self):
-        return self.project_builds
+        with self.lock:
+            return list(self.project_builds)
 
-    def start(self, project, branch, platform, noupload, s_backend, sign, split, split_arch, keep_log, clean, build, version, development, profiler, build_with_method, data, callback):
+    def get_queue(self):
+        with self.lock:
+            return list(self.queue)
+
+    def start(self, project, branch, platform, noupload, s_backend, sign, split, split_arch, keep_log, clean, build, version, development, profiler, build_with_method, data, callback, priority=0, force=False, restore_library=True, requested_at=None):
+        """Queues a build and returns its position in the queue, 0 if it has been started right away.
+        Builds with the same `requested_at` share one fetch of the mirror"""
+        proj_builder = ProjectBuilder(self, project, branch, platform, noupload, s_backend, sign, split, split_arch, keep_log, clean, build, version, development, profiler, build_with_method, data, callback, force, restore_library)
+        proj_builder.priority = priority
+        if requested_at is not None:
+            proj_builder.requested_at = requested_at
+        return self.enqueue(proj_builder)
+
+    def enqueue(self, proj_builder):
+        with self.lock:
+            #the same build is already waiting, just report to one more channel when it's done
+            for queued in self.queue:
+                if queued.get_build_key() == proj_builder.get_build_key():
+                    for data, callback in proj_builder.requesters:
+                        queued.add_requester(data, callback)
+                    return self.queue.index(queued) + 1
+            #same for a running one, unless it is already handing out its result
+            for running in self.project_builds:
+                if not running.finishing and running.get_build_key() == proj_builder.get_build_key():
+                    for data, callback in proj_builder.requesters:
+                        running.add_requester(data, callback)
+                    return 0
+
+            self.journal.write("queued", proj_builder.id, project_url=proj_builder.project.url, params=proj_builder.get_params(), \
+                priority=proj_builder.priority, requesters=[data for data, callback in proj_builder.requesters], \
+                groups=[get_group_record(callback) for data, callback in proj_builder.requesters])
+            self.queue_counter += 1
+            proj_builder.queue_index = self.queue_counter
+            self.queue.append(proj_builder)
+            self.queue.sort(key=lambda b: (-b.priority, b.queue_index))
+            self.schedule(proj_builder)
+
+            if proj_builder in self.queue:
+                return self.queue.index(proj_builder) + 1
+            return 0
+
+    def schedule(self, raise_for=None):
+        """Starts queued builds while there are free slots. Errors of `raise_for` are raised, the others are printed"""
+        with self.lock:
+            for proj_builder in list(self.queue):
+                if len(self.project_builds) >= config.MAX_CONCURRENT_BUILDS:
+                    break
+                if self.is_project_busy(proj_builder.project, proj_builder.platform):
+                    continue
+
+                self.queue.remove(proj_builder)
+                self.project_builds.append(proj_builder)
+                try:
+                    self.journal.write("started", proj_builder.id)
+                    proj_builder.build()
+                except Exception as ex:
+                    self.project_builds.remove(proj_builder)
+                    self.journal.write("finished", proj_builder.id)
+                    if proj_builder is raise_for:
+                        raise
+                    print("Failed to start build of %s: %s" % (proj_builder.project.name, str(ex)))
+                    #nobody waits on the command anymore, the requesters (and groups) hear it like a cancel
+                    proj_builder.cancel_queued("Failed to start the build: %s" % str(ex))
+
+    def is_project_busy(self, project, platform):
+        #every platform has its own working copy and logs, so only the same platform has to wait
         for proj_builder in self.project_builds:
-            if proj_builder.project.url.lower() == project.url.lower():
-                raise Exception("Project already in action")
+            if proj_builder.project.url.lower() == project.url.lower() and proj_builder.platform == platform:
+                return True
+        return False
+
+    def get_mirror_lock(self, url):
+        with self.lock:
+            key = url.lower()
+            if key not in self.mirror_locks:
+                self.mirror_locks[key] = threading.Lock()
+            return self.mirror_locks[key]
+
+    def acquire_unity_slot(self, unity_version, cancelled=None):
+        """Blocks until a build slot for the Unity version is free, returns the slot to release or None if unlimited.
+        Raises if the `cancelled` event gets set while waiting"""
+        with self.lock:
+            limit = config.MAX_CONCURRENT_BUILDS_PER_UNITY.get(unity_version, 0)
+            if limit <= 0:
+                return None
+            if unity_version not in self.unity_slots:
+                self.unity_slots[unity_version] = threading.BoundedSemaphore(limit)
+            slot = self.unity_slots[unity_version]
+        while not slot.acquire(timeout=1):
+            if cancelled is not None and cancelled.is_set():
+                raise Exception("Cancelled while waiting for a Unity %s slot" % unity_version)
+        return slot
+
+    def cancel(self, project, platform=None, reason="Cancelled"):
+        """Cancels queued and running builds of the project. Returns (number cancelled in queue, number running being stopped)"""
+        with self.lock:
+            queued = [b for b in self.queue if b.project.url.lower() == project.url.lower() and platform in (None, b.platform)]
+            running = [b for b in self.project_builds if b.project.url.lower() == project.url.lower() and platform in (None, b.platform)]
+            for proj_builder in queued:
+                self.queue.remove(proj_builder)
+                self.journal.write("finished", proj_builder.id)
+
+        for proj_builder in queued:
+            proj_builder.cancel_queued(reason)
+        for proj_builder in running:
+            proj_builder.cancel(reason)
+        return len(queued), len(running)
 
-        proj_builder = ProjectBuilder(self, project, branch, platform, noupload, s_backend, sign, split, split_arch, keep_log, clean, build, version, development, profiler, build_with_method, data, callback)
-        self.project_builds.append(proj_builder)
-        proj_builder.build()
-        
     def build_finished(self, proj_builder):
-        self.project_builds.remove(proj_builder)
+        with self.lock:
+            self.project_builds.remove(proj_builder)
+            self.journal.write("finished", proj_builder.id)
+            self.schedule()
+
+    def recover(self, projects, callback, group_callback):
+        """Re-queues builds interrupted by a restart. Returns (data, message) notices for the channels that requested them.
+        Platforms of a group report to a group again, with `group_callback`, those that can't be rebuilt are left out of it"""
+        notices = []
+        groups = {}
+        restarted = set()
+
+        def get_callback(group):
+            if group is None:
+                return callback
+            if group["id"] not in groups:
+                groups[group["id"]] = BuildGroup(group["platforms"], group_callback, group["id"])
+            return groups[group["id"]]
+
+        for pending in self.journal.load_pending():
+            for pid, executable in pending["pids"]:
+                if self.kill_orphan(pid, executable):
+                    print("Killed orphaned process %d (%s)" % (pid, executable))
+
+            #close the old entry, re-queueing journals the build again under a new id
+            self.journal.write("finished", pending["id"])
+
+            project = None
+            for p in projects:
+                if p.url.lower() == pending["project_url"].lower():
+                    project = p
+            params = pending["params"]
+            if project is None:
+                for data in pending["requesters"]:
+                    notices.append((data, "Build of %s was interrupted by a restart, but the project doesn't exist anymore" % pending["project_url"]))
+                continue
+
+            requesters = pending["requesters"]
+            callbacks = [get_callback(group) for group in pending["groups"]]
+            proj_builder = ProjectBuilder(self, project, data=requesters[0], callback=callbacks[0], **params)
+            proj_builder.priority = pending["priority"]
+            for data, requester_callback in zip(requesters[1:], callbacks[1:]):
+                proj_builder.requesters.append((data, requester_callback))
+            try:
+                position = self.enqueue(proj_builder)
+            except Exception as ex:
+                #one broken build must not keep the others, or Gaben, from starting
+                print("Failed to restart build of %s: %s" % (project.name, str(ex)))
+                for data in requesters:
+                    notices.append((data, "Build of *%s* (%s, %s) was interrupted by a restart and failed to start again: %s" % \
+                        (project.name, params["platform"], params["branch"], str(ex))))
+                continue
+
+            if pending["started"]:
+                stage = pending["jobs"][-1] if len(pending["jobs"]) > 0 else "start"
+                text = "Build of *%s* (%s, %s) was interrupted by a restart after %s" % (project.name, params["platform"], params["branch"], stage)
+            else:
+                text = "Build of *%s* (%s, %s) was waiting when Gaben restarted" % (project.name, params["platform"], params["branch"])
+            if position > 0:
+                text += ", re-queued at position %d" % position
+            else:
+                text += ", restarted"
+            for data, requester_callback in zip(requesters, callbacks):
+                notices.append((data, text))
+                if isinstance(requester_callback, BuildGroup):
+                    restarted.add((requester_callback.id, params["platform"]))
+
+        #results of platforms that finished before the restart, or didn't make it back, are gone
+        for group in groups.values():
+            for platform in list(group.platforms):
+                if (group.id, platform) not in restarted:
+                    group.forget(platform)
+
+        self.journal.compact()
+        return notices
+
+    def kill_orphan(self, pid, executable):
+        #the pid may have been reused since, only kill it if it still runs the same executable
+        name = os.path.basename(executable).lower()
+        try:
+            if os.name == "nt":
+                output = check_output(["tasklist", "/FI", "PID eq %d" % pid, "/NH"]).decode(errors="replace")
+                if name not in output.lower():
+                    return False
+                call(["taskkill", "/T", "/F", "/PID", str(pid)])
+            else:
+                output = check_output(["ps", "-p", str(pid), "-o", "command="]).decode(errors="replace")
+                if name not in output.lower():
+                    return False
+                #build processes lead their own process group, take their children down too
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                except OSError:
+                    os.kill(pid, signal.SIGTERM)
+        except (CalledProcessError, OSError):
+            return False
+        return True
 
     def get_url_hash(self, url):
         md5 = hashlib.md5(url.encode("utf-8"))
@@ -42,77 +267,372 @@ class Builder():
         else:
             return os.path.join(dir_, platform)
 
-    def get_project_temp_dir(self, url):
+    def get_mirror_dir(self, url):
+        return os.path.join(self.get_project_dir(url), "mirror.git")
+
+    def get_project_temp_dir(self, url, platform=None):
         hash_ = self.get_url_hash(url)
-        return os.path.join(self.rep_directory, hash_ + "_logs")
+        dir_ = os.path.join(self.rep_directory, hash_ + "_logs")
+        if platform is None:
+            return dir_
+        else:
+            return os.path.join(dir_, platform)
 
     def clean_project(self, project):
         shutil.rmtree(self.get_project_dir(project.url))
         shutil.rmtree(self.get_project_temp_dir(project.url))
 
+    def create_delivery(self, build_id, pinned=None):
+        """Returns a new directory for the files a build hands to its requesters. build() never wipes it,
+        it is removed once every holder released it, the build itself holds it until its callbacks are called.
+        `pinned` is an artifact cache key kept from eviction until then"""
+        path = os.path.join(self.deliveries_dir, build_id)
+        with self.lock:
+            self.deliveries[path] = {"holders": 1, "pinned": pinned, "keep_until": 0}
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def get_delivery(self, file_path):
+        return self.deliveries.get(os.path.dirname(os.path.abspath(file_path)))
+
+    def hold_delivery(self, file_path, count=1):
+        with self.lock:
+            delivery = self.get_delivery(file_path)
+            if delivery is not None:
+                delivery["holders"] += count
+
+    def keep_delivery(self, file_path, seconds):
+        """Leaves the files on disk for `seconds` after the last release, for messages and links pointing at them"""
+        with self.lock:
+            delivery = self.get_delivery(file_path)
+            if delivery is not None:
+                delivery["keep_until"] = max(delivery["keep_until"], time.time() + seconds)
+
+    def release_delivery(self, file_path):
+        """Called by every holder once it's done with the file, the last one removes the delivery"""
+        self.release_delivery_dir(os.path.dirname(os.path.abspath(file_path)))
+
+    def release_delivery_dir(self, path):
+        with self.lock:
+            delivery = self.deliveries.get(path)
+            if delivery is None:
+                return
+            delivery["holders"] -= 1
+            if delivery["holders"] > 0:
+                return
+            del self.deliveries[path]
+
+        if delivery["pinned"] is not None:
+            self.artifact_cache.unpin(delivery["pinned"])
+        if delivery["keep_until"] > time.time():
+            with open(os.path.join(path, DELIVERY_KEEP_MARKER), "w") as f:
+                f.write("%d" % delivery["keep_until"])
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+        self.clean_deliveries()
+
+    def clean_deliveries(self):
+        """Removes released deliveries whose links expired, and whatever the previous run left unreleased"""
+        if not os.path.isdir(self.deliveries_dir):
+            return
+        for name in os.listdir(self.deliveries_dir):
+            path = os.path.join(self.deliveries_dir, name)
+            with self.lock:
+                if path in self.deliveries:
+                    continue
+            try:
+                with open(os.path.join(path, DELIVERY_KEEP_MARKER), "r") as f:
+                    keep_until = int(f.read().strip())
+            except (IOError, ValueError):
+                keep_until = 0
+            if keep_until <= time.time():
+                shutil.rmtree(path, ignore_errors=True)
+
+
+
+
+DELIVERY_KEEP_MARKER = ".keep"
+
+
+class BuildGroup():
+    """Platforms requested by one build command, reports their results together once all of them are finished.
+    The group is the build callback of each of its platforms, it is journaled by id so recovery can put it back together"""
+    def __init__(self, platforms, done_callback, group_id=None):
+        self.id = group_id or uuid.uuid4().hex
+        self.platforms = list(platforms)
+        self.done_callback = done_callback
+        self.results = {}
+        self.data = None
+        self.project = None
+        self.done = False
+        self.lock = threading.Lock()
+
+    def __call__(self, data, project, platform, status, file_path, noupload):
+        with self.lock:
+            self.data = data
+            self.project = project
+            self.results[platform] = (status, file_path, noupload)
+        self.report()
+
+    def forget(self, platform):
+        """Stops waiting for a platform that won't report anymore"""
+        with self.lock:
+            if platform in self.platforms and platform not in self.results:
+                self.platforms.remove(platform)
+        self.report()
+
+    def report(self):
+        with self.lock:
+            #once, when the last platform is in, and only if any of them finished
+            if self.done or len(self.results) == 0 or len(self.results) < len(self.platforms):
+                return
+            self.done = True
+            results = [(p,) + self.results[p] for p in self.platforms]
+        self.done_callback(self.data, self.project, results)
+
+    def get_record(self):
+        return {"id": self.id, "platforms": list(self.platforms)}
+
+
+def get_group_record(callback):
+    #what the journal needs to put a group back together, None for plain callbacks
+    return callback.get_record() if isinstance(callback, BuildGroup) else None
 
 
 class ProjectBuilder():
-    def __init__(self, parent, project, branch, platform, noupload, s_backend, sign, split, split_arch, keep_log, clean, build, version, development, profiler, build_with_method, data, callback):
+    def __init__(self, parent, project, branch, platform, noupload, s_backend, sign, split, split_arch, keep_log, clean, build, version, development, profiler, build_with_method, data, callback, force=False, restore_library=True):
+        self.id = uuid.uuid4().hex
         self.parent = parent
         self.project = project
         self.noupload = noupload
         self.branch = branch
         self.platform = platform
         self.s_backend = s_backend
-        self.data = data
+        self.requesters = [(data, callback)]
         self.sign = sign
         self.split = split
         self.split_arch = split_arch
         self.keep_log = keep_log
-        self.callback = callback
         self.clean = clean
         self.build_number = build
         self.version = version
         self.development = development
         self.profiler = profiler
         self.build_with_method = build_with_method
+        self.force = force
+        self.restore_library = restore_library
 
-        self.temp_dir = self.parent.get_project_temp_dir(self.project.url)
+        self.temp_dir = self.parent.get_project_temp_dir(self.project.url, platform)
         self.project_dir = self.parent.get_project_dir(self.project.url, platform)
         self.bin_dir = os.path.join(self.project_dir, "bin")
+        self.library_dir = os.path.join(self.project_dir, "Library")
         self.build_log = os.path.join(self.temp_dir, "build_log.txt")
         self.unity_build_log = os.path.join(self.temp_dir, "unity_build_log.txt")
 
         self.pipeline = None
+        self.finishing = False
         self.unity_path = None
+        self.unity_version = None
+        self.unity_slot = None
+        self.priority = 0
+        self.queue_index = 0
+        self.requested_at = time.time()
+        self.started_at = None
+        self.build_timer = None
+        self.mirror_job = None
+        self.commit = None
+        self.cache_key = None
+        self.cached_artifact = None
+        self.library_key = None
+        self.unity_log_parser = UnityLogParser()
+        self.unity_started_at = None
+        self.reported_phase = None
+        self.reported_at = 0
+
+    def get_params(self):
+        return {"branch": self.branch, "platform": self.platform, "noupload": self.noupload, "s_backend": self.s_backend, \
+            "sign": self.sign, "split": self.split, "split_arch": self.split_arch, "keep_log": self.keep_log, "clean": self.clean, \
+            "build": self.build_number, "version": self.version, "development": self.development, "profiler": self.profiler, \
+            "build_with_method": self.build_with_method, "force": self.force, "restore_library": self.restore_library}
+
+    def get_build_key(self):
+        return (self.project.url.lower(), tuple(sorted(self.get_params().items())))
+
+    def add_requester(self, data, callback):
+        self.requesters.append((data, callback))
+        self.parent.journal.write("requester", self.id, data=data, group=get_group_record(callback))
+
+    def job_finished(self, pipeline, job):
+        self.parent.journal.write("job", self.id, job=str(job))
+
+        metrics = self.parent.metrics
+        stage = job.stage or "other"
+        if job.cpu_time is not None:
+            metrics.inc("gaben_job_cpu_seconds_total", job.cpu_time, project=self.project.name, stage=stage)
+        if job.peak_rss is not None:
+            metrics.set_max("gaben_job_peak_rss_bytes", job.peak_rss, project=self.project.name, stage=stage)
+        metrics.inc("gaben_job_output_bytes_total", job.output_bytes, project=self.project.name, stage=stage)
+
+    def process_started(self, job):
+        self.parent.journal.write("pid", self.id, pid=job.process.pid, executable=job.cmd[0])
+
+    def get_status(self):
+        if self.pipeline is None:
+            return "Finishing"
+        status = str(self.pipeline.get_current_job())
+        if self.unity_started_at is not None and self.unity_log_parser.phase is not None:
+            status += " [%s, %d min]" % (self.unity_log_parser.phase, (time.time() - self.unity_started_at) // 60)
+        return status
+
+    def unity_log_line(self, line):
+        self.unity_log_parser.feed(line)
+
+    def report_progress(self):
+        #called every poll of the unity log, sends at most one update per PROGRESS_UPDATE_INTERVAL
+        phase = self.unity_log_parser.phase
+        if self.parent.progress_callback is None or config.PROGRESS_UPDATE_INTERVAL <= 0:
+            return
+        if phase is None or phase == self.reported_phase or time.time() - self.reported_at < config.PROGRESS_UPDATE_INTERVAL:
+            return
+        self.reported_phase = phase
+        self.reported_at = time.time()
 
+        text = "Building *%s* (%s): %s (%d min)" % (self.project.name, self.platform, phase, (time.time() - self.unity_started_at) // 60)
+        for data, callback in self.requesters:
+            try:
+                self.parent.progress_callback(data, self.project, self.platform, text)
+            except Exception as ex:
+                print("Failed to report build progress: %s" % str(ex))
         
     def build(self):
+        self.started_at = time.time()
         if os.path.isdir(self.temp_dir):
             shutil.rmtree(self.temp_dir)
-        os.mkdir(self.temp_dir)
+        os.makedirs(self.temp_dir)
+        open(self.build_log, "w").close()
 
-        self.pipeline = Pipeline(self.pipeline_finished)
-        if not os.path.isdir(self.project_dir):
-            self.pipeline.add_job(ShellJob(["git", "clone", self.project.url, self.project_dir]))
-    
-        if self.clean:
-            self.pipeline.add_job(ShellJob(["git", "clean", "-fdx"], self.project_dir))
-        else:
-            self.pipeline.add_job(ShellJob(["git", "clean", "-fd"], self.project_dir))
-        self.pipeline.add_job(ShellJob(["git", "checkout", "."], self.project_dir))
-        self.pipeline.add_job(ShellJob(["git", "fetch", "origin", self.branch], self.project_dir))
-        self.pipeline.add_job(ShellJob(["git", "checkout", self.branch], self.project_dir))
-        self.pipeline.add_job(ShellJob(["git", "pull", "origin", self.branch], self.project_dir))
+        stage_timeouts = dict((stage, minutes * 60) for stage, minutes in config.STAGE_TIMEOUT_MINUTES.items())
+        self.pipeline = Pipeline(self.pipeline_finished, self.job_finished, self.build_log, stage_timeouts)
+        checkout = self.add_git_jobs()
+        commit = self.pipeline.add_job(PythonJob(self.get_commit), [checkout], "git")
 
+        #the build script and the unity version only need the working copy, so they go side by side
         script_path = os.path.join(self.project_dir, "Assets", "BatchBuild.cs")
-        self.pipeline.add_job(ShellJob(["cp", "-f", "./BatchBuild.cs", script_path]))
-        self.pipeline.add_job(PythonJob(self.prepare_vars, script_path))
-        self.pipeline.add_job(PythonJob(self.get_unity_version))
-        self.pipeline.add_job(PythonJob(self.generate_build_job))
+        copy = self.pipeline.add_job(ShellJob(["cp", "-f", "./BatchBuild.cs", script_path]), [checkout], "patch")
+        prepare = self.pipeline.add_job(PythonJob(self.prepare_vars, script_path), [copy], "patch")
+        unity_version = self.pipeline.add_job(PythonJob(self.get_unity_version), [checkout], "patch")
+        artifact_cache = self.pipeline.add_job(PythonJob(self.check_artifact_cache), [commit, unity_version], "cache")
+        library_cache = self.pipeline.add_job(PythonJob(self.restore_library_cache), [artifact_cache], "cache")
+        slot = self.pipeline.add_job(PythonJob(self.wait_unity_slot), [library_cache, prepare], "wait")
+        self.pipeline.add_job(PythonJob(self.generate_build_job), [slot], "patch")
 
+        if config.BUILD_TIMEOUT_MINUTES > 0:
+            self.build_timer = threading.Timer(config.BUILD_TIMEOUT_MINUTES * 60, self.cancel, \
+                ["Build timed out after %d minutes" % config.BUILD_TIMEOUT_MINUTES])
+            self.build_timer.daemon = True
+            self.build_timer.start()
         self.pipeline.start()
 
+    def cancel(self, reason):
+        """Stops a running build: kills its processes, skips the remaining jobs and fails it"""
+        if self.pipeline is None:
+            return
+        self.pipeline.cancel(reason)
+        mirror_job = self.mirror_job
+        if mirror_job is not None:
+            mirror_job.cancel(reason)
+
+    def cancel_queued(self, reason):
+        """Reports a build that never ran, removed from the queue or failed to start, as failed with the reason as its log"""
+        note_path = os.path.join(self.parent.create_delivery(self.id), "cancelled_%s.txt" % self.platform)
+        try:
+            with open(note_path, "w") as f:
+                f.write("%s\r\n" % reason)
+            self.hand_over(False, note_path)
+        finally:
+            self.parent.release_delivery(note_path)
+
+    def hand_over(self, status, file_path):
+        """Calls every requester back with the delivered file, each of them releases it when done"""
+        with self.parent.lock:
+            self.finishing = True
+            requesters = list(self.requesters)
+        self.parent.hold_delivery(file_path, len(requesters))
+        for data, callback in requesters:
+            try:
+                callback(data, self.project, self.platform, status, file_path, self.noupload)
+            except Exception as ex:
+                print("Failed to report build of %s: %s" % (self.project.name, str(ex)))
+                self.parent.release_delivery(file_path)
+
+    def add_git_jobs(self):
+        """Adds the jobs bringing the working copy to the requested branch, returns the last one"""
+        depth = ["--depth", str(self.project.fetch_depth)] if self.project.fetch_depth > 0 else []
+        mirror_dir = self.parent.get_mirror_dir(self.project.url)
+
+        if len(self.project.fetch_filter) > 0:
+            #a partial working copy has to lazy-load blobs from the real remote, the mirror can't serve them
+            source = self.project.url
+            if not os.path.isdir(self.project_dir):
+                self.pipeline.add_job(ShellJob(["git", "clone", "--no-checkout", "--single-branch", "--branch", self.branch, \
+                    "--filter=" + self.project.fetch_filter] + depth + [self.project.url, self.project_dir]), stage="git")
+        else:
+            #all platforms share one bare mirror, the only place that talks to the remote
+            source = mirror_dir
+            self.pipeline.add_job(PythonJob(self.update_mirror, mirror_dir, depth), stage="git")
+            if not os.path.isdir(self.project_dir):
+                self.pipeline.add_job(ShellJob(["git", "clone", "--shared", "--no-checkout", mirror_dir, self.project_dir]), stage="git")
+
+        filter_ = ["--filter=" + self.project.fetch_filter] if len(self.project.fetch_filter) > 0 else []
+        self.pipeline.add_job(ShellJob(["git", "remote", "set-url", "origin", source], self.project_dir), stage="git")
+        self.pipeline.add_job(ShellJob(["git", "fetch"] + depth + filter_ + ["origin", self.branch], self.project_dir), stage="git")
+        #hard reset to exactly the fetched commit, whatever state the working copy was left in
+        self.pipeline.add_job(ShellJob(["git", "checkout", "--force", "-B", self.branch, "FETCH_HEAD"], self.project_dir), stage="git")
+        if self.clean:
+            return self.pipeline.add_job(ShellJob(["git", "clean", "-fdx"], self.project_dir), stage="git")
+        else:
+            return self.pipeline.add_job(ShellJob(["git", "clean", "-fd"], self.project_dir), stage="git")
+
+    def update_mirror(self, mirror_dir, depth):
+        #platforms started together fetch once, whoever takes the lock first fetches for everybody
+        key = (self.project.url.lower(), self.branch)
+        with self.parent.get_mirror_lock(self.project.url):
+            if self.parent.mirror_fetched.get(key, 0) >= self.requested_at:
+                return "Mirror was fetched by a parallel build\r\n", "", 0
+
+            started = time.time()
+            commands = []
+            if not os.path.isdir(mirror_dir):
+                commands.append((["git", "init", "--bare", mirror_dir], None))
+                #working copies borrow the mirror's objects, so it must never prune them
+                commands.append((["git", "config", "gc.pruneExpire", "never"], mirror_dir))
+                commands.append((["git", "remote", "add", "origin", self.project.url], mirror_dir))
+            commands.append((["git", "fetch"] + depth + ["origin", "+refs/heads/%s:refs/heads/%s" % (self.branch, self.branch)], mirror_dir))
+
+            for cmd, cwd in commands:
+                if self.pipeline.cancelled.is_set():
+                    return "Cancelled\r\n", "", 1
+                job = ShellJob(cmd, cwd)
+                job.log_path = self.build_log
+                self.mirror_job = job
+                try:
+                    job.do()
+                finally:
+                    self.mirror_job = None
+                if job.is_failed():
+                    return "%s failed\r\n" % " ".join(cmd), job.output_error, job.error_code
+
+            self.parent.mirror_fetched[key] = started
+            return "Mirror fetched\r\n", "", 0
+
     def generate_build_job(self):
+        self.unity_started_at = time.time()
         self.pipeline.add_job(ShellJob([self.unity_path, "-batchmode", "-buildTarget", self.platform, \
             "-projectPath", self.project_dir, "-executeMethod", "BatchBuild.Build" + self.platform, \
-            "-logFile", self.unity_build_log], self.project_dir, output_from_file=self.unity_build_log))
+            "-logFile", self.unity_build_log], self.project_dir, output_from_file=self.unity_build_log, process_callback=self.process_started, \
+            line_callback=self.unity_log_line, tick_callback=self.report_progress), stage="unity")
 
         return "Build job created\r\n", "", 0
 
@@ -127,9 +647,54 @@ class ProjectBuilder():
         if unity_version not in config.UNITY:
             raise Exception("Unity version %s not found" % unity_version)
         self.unity_path = config.UNITY[unity_version]
+        self.unity_version = unity_version
 
         return "Detected unity version " + unity_version + "\r\n", "", 0
 
+    def get_commit(self):
+        self.commit = check_output(["git", "rev-parse", "HEAD"], cwd=self.project_dir).decode().strip()
+        return "Building commit %s\r\n" % self.commit, "", 0
+
+    def check_artifact_cache(self):
+        if not self.parent.artifact_cache.is_enabled():
+            return "Artifact cache is disabled\r\n", "", 0
+
+        #noupload and force change what happens to the build, not the build itself
+        params = self.get_params()
+        del params["noupload"]
+        del params["force"]
+        del params["restore_library"]
+        self.cache_key = self.parent.artifact_cache.get_key(url=self.project.url.lower(), commit=self.commit, params=params, \
+            unity=self.unity_version, keystore=self.project.keystore_filename, key=self.project.key)
+
+        if self.force:
+            return "Forced build, artifact cache skipped\r\n", "", 0
+        #pinned until the delivery made of it is released
+        self.cached_artifact = self.parent.artifact_cache.get(self.cache_key, pin=True)
+        if self.cached_artifact is None:
+            return "No cached build found\r\n", "", 0
+
+        self.pipeline.stop()
+        return "Found cached build of commit %s: %s\r\n" % (self.commit, self.cached_artifact), "", 0
+
+    def restore_library_cache(self):
+        cache = self.parent.library_cache
+        if not cache.is_enabled():
+            return "Library cache is disabled\r\n", "", 0
+        self.library_key = cache.get_key(url=self.project.url.lower(), platform=self.platform, unity=self.unity_version)
+
+        if not self.restore_library:
+            return "Library cache restore skipped\r\n", "", 0
+        if os.path.isdir(self.library_dir):
+            return "Library is in place\r\n", "", 0
+        if cache.restore(self.library_key, self.library_dir):
+            return "Library restored from cache\r\n", "", 0
+        return "No cached Library found\r\n", "", 0
+
+    def wait_unity_slot(self):
+        self.unity_slot = self.parent.acquire_unity_slot(self.unity_version, self.pipeline.cancelled)
+        return "Unity %s slot acquired\r\n" % self.unity_version, "", 0
+
 
     def prepare_vars(self, script_path):
         self.cleanup(True)
@@ -167,10 +732,56 @@ class ProjectBuilder():
 
 
     def pipeline_finished(self, pipeline):
+        delivery_dir = None
+        try:
+            if self.build_timer is not None:
+                self.build_timer.cancel()
 
-        with open(self.build_log, "w") as f:
-            f.write(pipeline.get_output_log())
-        
+            failed = pipeline.failed
+            try:
+                #uploads may wait long after the next build of the project wiped bin and temp_dir, they get their own copy
+                delivery_dir = self.parent.create_delivery(self.id, self.cache_key if self.cached_artifact is not None else None)
+                build_path, archive_time, artifact = self.make_artifact(pipeline, delivery_dir)
+            except Exception as ex:
+                print("Failed to prepare build of %s for delivery: %s" % (self.project.name, str(ex)))
+                failed = True
+                build_path, archive_time, artifact = self.write_failure(delivery_dir, "Failed to prepare the build for delivery: %s" % str(ex)), None, False
+
+            if not failed and self.cached_artifact is None and self.cache_key is not None and artifact:
+                try:
+                    self.parent.artifact_cache.put(self.cache_key, build_path)
+                except Exception as ex:
+                    print("Failed to cache build of %s: %s" % (self.project.name, str(ex)))
+
+            stage_times = pipeline.get_stage_times()
+            if archive_time is not None:
+                stage_times["archive"] = archive_time
+            for stage, seconds in stage_times.items():
+                self.parent.metrics.observe("gaben_stage_seconds", seconds, project=self.project.name, stage=stage)
+            result = "failed" if failed else ("cached" if self.cached_artifact is not None else "success")
+            self.parent.metrics.inc("gaben_builds_total", project=self.project.name, platform=self.platform, result=result)
+            self.record_history(pipeline, result, build_path, stage_times)
+            self.hand_over(not failed, build_path)
+
+            if not failed and self.cached_artifact is None and self.library_key is not None:
+                try:
+                    self.parent.library_cache.snapshot(self.library_key, self.library_dir)
+                except Exception as ex:
+                    print("Failed to snapshot Library of %s: %s" % (self.project.name, str(ex)))
+        finally:
+            #whatever failed above, the build must give back its slots or it blocks the queue for good
+            if self.unity_slot is not None:
+                self.unity_slot.release()
+                self.unity_slot = None
+            if delivery_dir is not None:
+                self.parent.release_delivery_dir(delivery_dir)
+            try:
+                self.cleanup()
+            finally:
+                self.parent.build_finished(self)
+
+    def make_artifact(self, pipeline, delivery_dir):
+        """Puts what the build produced into `delivery_dir`, returns (path, seconds spent archiving or None, False if it's the log)"""
         if os.path.exists(self.bin_dir):
             #remove symbols
             for f in os.listdir(self.bin_dir):
@@ -183,21 +794,51 @@ class ProjectBuilder():
         if self.keep_log and os.path.exists(self.bin_dir) and not pipeline.failed:
             shutil.copyfile(self.build_log, os.path.join(self.bin_dir, "build_log.txt"))
             files.append("build_log.txt")
-        
-        if len(files) > 1 or (len(files) == 1 and os.path.isdir(os.path.join(self.bin_dir, files[0]))):
-            build_path = os.path.join(self.temp_dir, self.project.name)
-            shutil.make_archive(build_path, 'zip', self.bin_dir)
-            build_path += ".zip"
+
+        if self.cached_artifact is not None:
+            build_path = os.path.join(delivery_dir, os.path.basename(self.cached_artifact))
+            link_or_copy(self.cached_artifact, build_path)
+        elif len(files) > 1 or (len(files) == 1 and os.path.isdir(os.path.join(self.bin_dir, files[0]))):
+            archive_started = time.time()
+            build_path = self.parent.archiver.make_archive(os.path.join(delivery_dir, self.project.name), self.bin_dir)
+            return build_path, time.time() - archive_started, True
         elif len(files) == 1:
-            build_path = os.path.join(self.bin_dir, files[0])
+            build_path = os.path.join(delivery_dir, files[0])
+            shutil.move(os.path.join(self.bin_dir, files[0]), build_path)
         else:
-            build_path = self.build_log
-            
-        self.callback(self.data, self.project, not pipeline.failed, build_path, self.noupload)
-        self.cleanup()
-        self.parent.build_finished(self)
+            build_path = os.path.join(delivery_dir, os.path.basename(self.build_log))
+            shutil.copyfile(self.build_log, build_path)
+            return build_path, None, False
+        return build_path, None, True
+
+    def write_failure(self, delivery_dir, reason):
+        """Appends `reason` to the build log and returns the log to deliver, a copy in `delivery_dir` if it can be made"""
+        path = self.build_log
+        try:
+            with open(self.build_log, "a", encoding="utf-8", errors="replace") as f:
+                f.write("%s\r\n" % reason)
+            if delivery_dir is not None:
+                delivered = os.path.join(delivery_dir, os.path.basename(self.build_log))
+                shutil.copyfile(self.build_log, delivered)
+                path = delivered
+        except (IOError, OSError) as ex:
+            print("Failed to write build log of %s: %s" % (self.project.name, str(ex)))
+        return path
 
 
+    def record_history(self, pipeline, result, build_path, stage_times):
+        params = self.get_params()
+        del params["branch"]
+        del params["platform"]
+        failed_job = pipeline.get_failed_job()
+        size = os.path.getsize(build_path) if result != "failed" and os.path.isfile(build_path) else None
+        try:
+            self.parent.history.add(self.id, self.project.name, self.project.url, self.branch, self.platform, self.commit, \
+                self.unity_version, params, result, str(failed_job) if failed_job is not None else None, \
+                self.started_at or self.requested_at, time.time(), size, stage_times)
+        except Exception as ex:
+            print("Failed to record build history of %s: %s" % (self.project.name, str(ex)))
+
     def cleanup(self, recreate=False):
         if os.path.isdir(self.bin_dir):
             shutil.rmtree(self.bin_dir)
@@ -207,57 +848,214 @@ class ProjectBuilder():
 
 
 class Pipeline(threading.Thread):
-    def __init__(self, done_callback):
+    """Runs jobs as soon as the jobs they depend on are finished, independent ones in parallel"""
+    MAX_PARALLEL_JOBS = 4
+
+    def __init__(self, done_callback, job_callback=None, log_path=None, stage_timeouts=None):
         super(Pipeline, self).__init__()
         self._jobs = []
+        self._depends = {}
+        self._running = set()
+        self._condition = threading.Condition()
         self.done_callback = done_callback
+        self.job_callback = job_callback
+        self.log_path = log_path
+        self.stage_timeouts = stage_timeouts or {}
         self.running = False
         self.failed = False
+        self.stopped = False
+        self.done = False
+        self.cancelled = threading.Event()
 
     def get_current_job(self):
-        for j in self._jobs:
+        with self._condition:
+            jobs = list(self._jobs)
+        for j in jobs:
+            if j.started_at is not None and not j.finished:
+                return j
+        for j in jobs:
             if not j.finished:
                 return j
-        if len(self._jobs) > 0:
-            return self._jobs[-1]
+        if len(jobs) > 0:
+            return jobs[-1]
         else:
             return None
 
-    def get_output_log(self):
-        output = ""
-        for j in self._jobs:
-            if j.finished:
-                output += j.output
-        return output
+    def get_tail(self, lines=None):
+        job = self.get_current_job()
+        if job is None:
+            return ""
+        return job.get_tail(lines)
+
+    def stop(self):
+        """Skips the jobs that haven't started yet, the pipeline finishes normally"""
+        with self._condition:
+            self.stopped = True
+            self._condition.notify_all()
+
+    def cancel(self, reason):
+        """Fails the pipeline: jobs that haven't started are skipped, running ones are killed"""
+        with self._condition:
+            if self.cancelled.is_set() or self.done:
+                return
+            self.cancelled.set()
+            self.failed = True
+            running = list(self._running)
+            self._condition.notify_all()
+        print("Pipeline cancelled: %s" % reason)
+        self._write_log("%s\r\n" % reason)
+        for job in running:
+            job.cancel(reason)
 
-    def add_job(self, job):
-        self._jobs.append(job)
+    def add_job(self, job, depends=None, stage=None):
+        """Adds a job that runs after `depends`, by default after the job added last. Jobs may be added while the pipeline runs"""
+        if job.log_path is None:
+            job.log_path = self.log_path
+        if stage is not None:
+            job.stage = stage
+        with self._condition:
+            if depends is None:
+                depends = self._jobs[-1:]
+            self._depends[job] = list(depends)
+            self._jobs.append(job)
+            self._condition.notify_all()
+        return job
 
     def run(self):
         self.running = True
+        running = self._running
+        with ThreadPoolExecutor(self.MAX_PARALLEL_JOBS) as executor, self._condition:
+            while True:
+                if not self.stopped and not self.failed:
+                    for job in self._get_ready_jobs(running):
+                        print("Start %s" % (job,))
+                        job.started_at = time.time()
+                        running.add(job)
+                        executor.submit(self._run_job, job, running)
+                if len(running) == 0:
+                    self.done = True
+                    break
+                self._condition.wait()
+        self.running = False
+        self.done_callback(self)
+
+    def _get_ready_jobs(self, running):
+        ready = []
         for job in self._jobs:
-            if job.finished:
+            if job.finished or job in running:
                 continue
-            print("Start %s" % (job,))
+            if all(d.finished and not d.is_failed() for d in self._depends[job]):
+                ready.append(job)
+        return ready
+
+    def _run_job(self, job, running):
+        timer = None
+        timeout = self.stage_timeouts.get(job.stage, 0)
+        if timeout > 0:
+            timer = threading.Timer(timeout, self.cancel, ["Stage %s timed out after %d minutes" % (job.stage, timeout // 60)])
+            timer.daemon = True
+            timer.start()
+        try:
             job.do()
-            if job.is_failed():
-                self.failed = True
-                self.done_callback(self)
-                return
-        self.running = False
-        self.done_callback(self)
+        except Exception as ex:
+            job.output_error = str(ex)
+            job.error_code = 1
+            job.finished = True
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self._log_timing(job)
+        try:
+            if self.job_callback is not None:
+                self.job_callback(self, job)
+        finally:
+            with self._condition:
+                running.discard(job)
+                if job.is_failed():
+                    self.failed = True
+                self._condition.notify_all()
+
+    def get_failed_job(self):
+        with self._condition:
+            for job in self._jobs:
+                if job.finished and job.is_failed():
+                    return job
+        return None
+
+    def get_stage_times(self):
+        """Returns seconds spent per job stage, jobs without a stage count as other"""
+        times = {}
+        with self._condition:
+            jobs = list(self._jobs)
+        for job in jobs:
+            if job.wall_time is not None:
+                stage = job.stage or "other"
+                times[stage] = times.get(stage, 0) + job.wall_time
+        return times
+
+    def _log_timing(self, job):
+        job.wall_time = time.time() - job.started_at
+        self._write_log("%s finished with %s in %.1f s\r\n" % (job, job.error_code, job.wall_time))
+
+    def _write_log(self, text):
+        if self.log_path is None:
+            return
+        try:
+            with open(self.log_path, "a", encoding="utf-8", errors="replace") as f:
+                f.write(text)
+        except Exception as ex:
+            print("Failed to write build log: %s" % str(ex))
+
 
-    
 class Job:
     def __init__(self):
         self.finished = False
+        self.stage = None
+        self.started_at = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.output_bytes = 0
         self.output = ""
         self.output_error = ""
         self.error_code = 0
+        self.log_path = None
+        self.tail = collections.deque(maxlen=config.OUTPUT_TAIL_LINES)
+        self._log_file = None
+        self._output_lock = threading.Lock()
 
     def is_failed(self):
         return self.error_code != 0
 
+    def cancel(self, reason):
+        """Stops the job if it can be stopped, plain python jobs run to the end"""
+        pass
+
+    def open_log(self):
+        if self.log_path is not None:
+            self._log_file = open(self.log_path, "a", encoding="utf-8", errors="replace")
+
+    def close_log(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def write_output(self, text):
+        """Appends output to the log file and keeps the last lines in memory"""
+        with self._output_lock:
+            if self._log_file is not None:
+                self._log_file.write(text)
+                self._log_file.flush()
+            self.output_bytes += len(text.encode("utf-8", "replace"))
+            self.tail.extend(text.splitlines(True))
+
+    def get_tail(self, lines=None):
+        with self._output_lock:
+            tail = list(self.tail)
+        if lines is not None:
+            tail = tail[-lines:]
+        return "".join(tail)
+
 
 class PythonJob(Job):
     def __init__(self, action, *args, **kwargs):
@@ -272,6 +1070,7 @@ class PythonJob(Job):
     def do(self):
         if self.finished:
             raise Exception("Job already finished")
+        cpu_started = time.thread_time()
         try:
             self.output, self.output_error, self.error_code = self.action(*self.args, **self.kwargs)
         except Exception as ex:
@@ -280,6 +1079,14 @@ class PythonJob(Job):
             self.output = str(ex) + "\r\n" + "\r\n".join(formatted_lines)
             self.output_error = self.output
             self.error_code = 1
+
+        self.cpu_time = time.thread_time() - cpu_started
+
+        self.open_log()
+        try:
+            self.write_output(self.output)
+        finally:
+            self.close_log()
         self.finished = True
 
         print("%s finished with %s" % (self, self.error_code))
@@ -287,39 +1094,198 @@ class PythonJob(Job):
 
 
 class ShellJob(Job):
-    def __init__(self, cmd, cwd=None, shell=False, output_from_file=None):
+    def __init__(self, cmd, cwd=None, shell=False, output_from_file=None, process_callback=None, line_callback=None, tick_callback=None):
         super(ShellJob, self).__init__()
         self.cmd = cmd
         self.cwd = cwd
         self.shell = shell
         self.output_from_file = output_from_file
+        self.process_callback = process_callback
+        self.line_callback = line_callback
+        self.tick_callback = tick_callback
+        self.process = None
+        self.exited = False
+        self.cancel_reason = None
+        self.error_tail = collections.deque(maxlen=config.OUTPUT_TAIL_LINES)
 
     def do(self):
         if self.finished:
             raise Exception("Job already finished")
-        self.output, self.output_error, self.error_code = self._popen(self.cmd, self.cwd, self.shell)
-
-        try:
-            self.output = self.output.decode()
-        except AttributeError:
-            pass
-
-        try:
-            self.output_error = self.output_error.decode()
-        except AttributeError:
-            pass
 
+        self.open_log()
+        follower = None
         if self.output_from_file is not None:
-            with open(self.output_from_file, "r") as f:
-                self.output = f.read()
+            #the process writes its own log file, follow it while it runs
+            follower = LogFollower(self.output_from_file, self._followed_line, self.tick_callback)
+            follower.start()
+        try:
+            self.error_code = self._popen(self.cmd, self.cwd, self.shell)
+        except Exception as ex:
+            self.write_output("%s\r\n" % str(ex))
+            self.error_tail.append("%s\r\n" % str(ex))
+            self.error_code = 1
+        finally:
+            if follower is not None:
+                follower.stop()
+            self.close_log()
 
+        self.output = self.get_tail()
+        self.output_error = "".join(self.error_tail)
         self.finished = True
         print("%s finished with %s" % (self, self.error_code))
     
     def __str__(self):
         return "ShellJob[cmd=%s, shell=%s]" % (self.cmd, self.shell)
     
+    def cancel(self, reason):
+        self.cancel_reason = reason
+        process = self.process
+        if process is None or self.exited:
+            return
+        print("Killing %s: %s" % (self, reason))
+        if os.name == "nt":
+            call(["taskkill", "/T", "/F", "/PID", str(process.pid)])
+            return
+        #the process leads its own group, so this reaches everything it started
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            return
+        timer = threading.Timer(10, self._kill_group, [process.pid])
+        timer.daemon = True
+        timer.start()
+
+    def _kill_group(self, pgid):
+        if self.finished:
+            return
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError:
+            pass
+
     def _popen(self, cmd, cwd=None, shell=False):
-        result = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=PIPE, shell=shell)
-        out, out_err = result.communicate()
-        return out, out_err, result.returncode
\ No newline at end of file
+        if os.name == "nt":
+            result = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=PIPE, shell=shell, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            result = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=PIPE, shell=shell, start_new_session=True)
+        self.process = result
+        if self.cancel_reason is not None:
+            self.cancel(self.cancel_reason)
+        if self.process_callback is not None:
+            self.process_callback(self)
+
+        readers = [threading.Thread(target=self._pump, args=(result.stdout, None)), \
+            threading.Thread(target=self._pump, args=(result.stderr, self.error_tail))]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        code = self._wait(result)
+        self.exited = True
+        return code
+
+    def _wait(self, process):
+        if not hasattr(os, "wait4"):
+            return process.wait()
+        #wait4 also returns the resource usage of the child, which Popen.wait throws away
+        pid, status, usage = os.wait4(process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        self.cpu_time = usage.ru_utime + usage.ru_stime
+        #bytes on macOS, kilobytes elsewhere
+        self.peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        return process.returncode
+
+    def _followed_line(self, line):
+        self.write_output(line)
+        if self.line_callback is not None:
+            self.line_callback(line)
+
+    def _pump(self, stream, error_tail):
+        #bounded reads so a huge line without a newline can't blow up memory either
+        for raw in iter(lambda: stream.readline(65536), b""):
+            line = raw.decode(errors="replace")
+            self.write_output(line)
+            if error_tail is not None:
+                error_tail.append(line)
+        stream.close()
+
+
+class LogFollower(threading.Thread):
+    """Polls a file another process appends to and hands over complete lines as they appear"""
+    def __init__(self, path, line_callback, tick_callback=None, interval=1):
+        super(LogFollower, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.line_callback = line_callback
+        self.tick_callback = tick_callback
+        self.interval = interval
+        self.offset = 0
+        self.partial = b""
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+            if self.tick_callback is not None:
+                self.tick_callback()
+        self.poll(final=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def poll(self, final=False):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < self.offset:
+            #file was recreated, start over
+            self.offset = 0
+            self.partial = b""
+
+        if size > self.offset:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                while True:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        break
+                    self.offset += len(chunk)
+                    lines = (self.partial + chunk).split(b"\n")
+                    self.partial = lines.pop()
+                    if len(self.partial) > 65536:
+                        lines.append(self.partial)
+                        self.partial = b""
+                    for line in lines:
+                        self.line_callback((line + b"\n").decode(errors="replace"))
+
+        if final and len(self.partial) > 0:
+            self.line_callback(self.partial.decode(errors="replace"))
+            self.partial = b""
+
+
+class UnityLogParser:
+    """Tracks the current build phase from the markers Unity writes to its log"""
+    MARKERS = [
+        (re.compile(r"DisplayProgressbar: (.+)"), "%s"),
+        (re.compile(r"DisplayProgressNotification: (.+)"), "%s"),
+        (re.compile(r"Start importing .+ using"), "Importing assets"),
+        (re.compile(r"^- starting compile", re.IGNORECASE), "Compiling scripts"),
+        (re.compile(r"Build Finished, Result: (\w+)"), "Build finished: %s"),
+    ]
+
+    def __init__(self):
+        self.phase = None
+
+    def feed(self, line):
+        for regex, label in self.MARKERS:
+            match = regex.search(line)
+            if match is None:
+                continue
+            groups = tuple(g.strip() for g in match.groups())
+            self.phase = label % groups if len(groups) > 0 else label
+            return
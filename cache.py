@@ -0,0 +1,197 @@
+from subprocess import call
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+
+class DirectoryCache:
+    """Entries stored as subdirectories of `directory`, described by a json index"""
+    def __init__(self, directory, max_size_mb):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.max_size = max_size_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.pins = {}
+
+    def is_enabled(self):
+        return self.max_size > 0
+
+    def get_key(self, **parts):
+        text = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _evict(self, index, keep, max_age=0):
+        now = time.time()
+        for key in list(index):
+            if max_age > 0 and key != keep and key not in self.pins and now - index[key]["last_used"] > max_age:
+                self._remove(index, key)
+
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total <= self.max_size:
+                break
+            if key == keep or key in self.pins:
+                continue
+            total -= index[key]["size"]
+            self._remove(index, key)
+
+    def pin(self, key):
+        """Keeps the entry from being evicted until `unpin`, calls nest"""
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            else:
+                self.pins.pop(key, None)
+
+    def _remove(self, index, key):
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+        del index[key]
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_path, self.index_path)
+
+
+class ArtifactCache(DirectoryCache):
+    """Finished builds keyed by commit, build parameters and Unity version, evicted least recently used first"""
+    def get(self, key, pin=False):
+        """Returns the path of the cached artifact or None. With `pin` a found entry is pinned, see `unpin`"""
+        with self.lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self.directory, key, entry["file"])
+            if not os.path.isfile(path):
+                del index[key]
+                self._save_index(index)
+                return None
+            entry["last_used"] = time.time()
+            self._save_index(index)
+            if pin:
+                self.pins[key] = self.pins.get(key, 0) + 1
+            return path
+
+    def put(self, key, file_path):
+        """Stores a copy of the artifact, a hardlink where possible, and returns its path in the cache"""
+        with self.lock:
+            index = self._load_index()
+            entry_dir = os.path.join(self.directory, key)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.makedirs(entry_dir)
+
+            name = os.path.basename(file_path)
+            path = os.path.join(entry_dir, name)
+            link_or_copy(file_path, path)
+            index[key] = {"file": name, "size": os.path.getsize(path), "last_used": time.time()}
+            self._evict(index, key)
+            self._save_index(index)
+            return path
+
+
+class LibraryCache(DirectoryCache):
+    """Snapshots of Unity's Library folder per project, platform and Unity version"""
+    def __init__(self, directory, max_size_mb, max_age_days, refresh_hours):
+        super(LibraryCache, self).__init__(directory, max_size_mb)
+        self.max_age = max_age_days * 24 * 3600
+        self.refresh = refresh_hours * 3600
+
+    def restore(self, key, library_dir):
+        """Copies the snapshot to `library_dir` if there is one, returns True if it did"""
+        with self.lock:
+            index = self._load_index()
+            entry = index.get(key)
+            snapshot_dir = os.path.join(self.directory, key, "Library")
+            if entry is None or not os.path.isdir(snapshot_dir):
+                return False
+            entry["last_used"] = time.time()
+            self._save_index(index)
+            copy_tree(snapshot_dir, library_dir)
+            return True
+
+    def snapshot(self, key, library_dir):
+        """Stores a copy of `library_dir` unless the current snapshot is fresh enough, returns True if it copied"""
+        if not os.path.isdir(library_dir):
+            return False
+
+        with self.lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry is not None and time.time() - entry["created"] < self.refresh:
+                entry["last_used"] = time.time()
+                self._save_index(index)
+                return False
+
+        #copy outside of the lock, it may take a while, then swap it in
+        entry_dir = os.path.join(self.directory, key)
+        temp_dir = entry_dir + ".tmp"
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+        copy_tree(library_dir, os.path.join(temp_dir, "Library"))
+        size = get_tree_size(temp_dir)
+
+        with self.lock:
+            index = self._load_index()
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.replace(temp_dir, entry_dir)
+            index[key] = {"size": size, "created": time.time(), "last_used": time.time()}
+            self._evict(index, key, self.max_age)
+            self._save_index(index)
+        return True
+
+
+def copy_tree(src, dst):
+    #Unity rewrites Library files in place, so hardlinks would corrupt the snapshot,
+    #but copy-on-write clones are safe and nearly free where the filesystem supports them
+    if os.name != "nt":
+        parent = os.path.dirname(dst)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        try:
+            if call(["cp", "-a", "--reflink=auto", src, dst]) == 0:
+                return
+        except OSError:
+            pass
+        shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(src, dst)
+
+
+def link_or_copy(src, dst):
+    #artifacts are never written to once finished, so a hardlink is as good as a copy
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def get_tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
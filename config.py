@@ -1,7 +1,36 @@
 API_KEY = ""
 DONT_PRINT_USAGE_FOR = []
 REP_DIRECTORY = "C:\\GabenStorage"
+STORE_BACKEND = "sqlite"
 MAX_UPLOAD_SIZE_MB = 300
+UPLOAD_CONCURRENCY = 2
+UPLOAD_BANDWIDTH_KBPS = 0
+ARTIFACT_SERVER_HOST = "0.0.0.0"
+ARTIFACT_SERVER_PORT = 0
+ARTIFACT_SERVER_URL = ""
+ARTIFACT_LINK_TTL_HOURS = 72
+ARTIFACT_CACHE_SIZE_MB = 20480
+LIBRARY_CACHE_SIZE_MB = 51200
+LIBRARY_CACHE_MAX_AGE_DAYS = 14
+LIBRARY_CACHE_REFRESH_HOURS = 24
+ARCHIVE_FORMAT = "zip"
+ARCHIVE_COMPRESSION_LEVEL = 6
+ARCHIVE_WORKERS = 0
+ARCHIVE_STORE_EXTENSIONS = ["apk", "aab", "obb", "ipa", "zip", "gz", "7z", "png", "jpg", "mp3", "ogg", "mp4", "unity3d"]
+OUTPUT_TAIL_LINES = 200
+PROGRESS_UPDATE_INTERVAL = 60
+MAX_CONCURRENT_BUILDS = 2
+MAX_CONCURRENT_BUILDS_PER_UNITY = {}
+BUILD_TIMEOUT_MINUTES = 360
+STAGE_TIMEOUT_MINUTES = {"git": 60, "unity": 240}
+PING_INTERVAL = 30
+SLACK_MESSAGE_RATE = 1.0
+SLACK_POOL_SIZE = 10
+RTM_BATCH_SIZE = 100
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+ASYNC_DISPATCHER = False
+USER_CACHE_TTL = 3600
 UNITY = {
     "2017.2.0f3": "C:\\Program Files\\Unity\\Editor\\Unity.exe",
 	"2017.4.3f1": "C:\\Program Files\\Unity2017.4.3\\Editor\\Unity.exe"
@@ -2,11 +2,18 @@
 # -*- coding: utf-8 -*-
 
 from store import Store, Project
-from builder import Builder
+from builder import Builder, BuildGroup
+from uploader import UploadWorker
+from artifactserver import ArtifactServer
+from metrics import MetricsServer
 from io import StringIO
 from args import ArgumentParser
-from slackclient import SlackClient
+from slackclient import SlackClient, AsyncSlackClient
+from slackclient.slackrequest import Throttle
 
+import asyncio
+import traceback
+import threading
 import time
 import re
 import json
@@ -20,32 +27,107 @@ import shlex
 class Gaben:
     def __init__(self, api_key, rep_directory):
         self.api_key = api_key
-        self.slack = SlackClient(api_key)
+        self.slack = SlackClient(api_key, user_cache_ttl=config.USER_CACHE_TTL, message_rate=config.SLACK_MESSAGE_RATE, \
+            pool_size=config.SLACK_POOL_SIZE)
         self.store = Store()
-        self.builder = Builder(rep_directory)
+        self.builder = Builder(rep_directory, self.builder_progress)
+        self.aslack = None
+        self.loop = None
+        self.tasks = set()
+        self.progress_messages = {}
+        self.progress_lock = threading.Lock()
+        self.uploader = UploadWorker(config.UPLOAD_CONCURRENCY)
+        self.upload_throttle = Throttle(config.UPLOAD_BANDWIDTH_KBPS * 1024) if config.UPLOAD_BANDWIDTH_KBPS > 0 else None
+        self.artifact_server = ArtifactServer(rep_directory, config.ARTIFACT_SERVER_HOST, config.ARTIFACT_SERVER_PORT, \
+            config.ARTIFACT_SERVER_URL, config.ARTIFACT_LINK_TTL_HOURS)
+        if self.artifact_server.is_enabled():
+            self.artifact_server.start()
+        self.register_metrics()
+
+    def register_metrics(self):
+        metrics = self.builder.metrics
+        metrics.register("gaben_running_builds", "gauge", lambda: len(self.builder.get_jobs()), "Builds running right now")
+        metrics.register("gaben_queued_builds", "gauge", lambda: len(self.builder.get_queue()), "Builds waiting for a free slot")
+        metrics.register("gaben_pending_uploads", "gauge", self.uploader.get_pending, "Finished builds waiting for the upload worker")
+        metrics.register("gaben_user_cache_hits_total", "counter", lambda: self.slack.server.user_cache.stats()["hits"])
+        metrics.register("gaben_user_cache_misses_total", "counter", lambda: self.slack.server.user_cache.stats()["misses"])
+        metrics.register("gaben_outbox_depth", "gauge", lambda: self.slack.server.outbox.depth(), "RTM messages waiting to be sent")
+        metrics.register("gaben_outbox_channels", "gauge", lambda: len(self.slack.server.outbox.depth_by_channel()), \
+            "Channels with RTM messages waiting for the rate limit")
+        for name in ("sent", "merged", "split", "retried", "dropped"):
+            metrics.register("gaben_outbox_%s_total" % name, "counter", lambda name=name: self.slack.server.outbox.stats()[name])
+        server = MetricsServer(metrics, config.METRICS_HOST, config.METRICS_PORT)
+        if server.is_enabled():
+            server.start()
 
     def run(self):
         if self.slack.rtm_connect(auto_reconnect=True):
             print("Gabe is ready!")
+            self.recover_builds()
+            last_ping = time.time()
             while True:
-                data_list = self.slack.rtm_read()
-                for data in data_list:
-                    if "type" in data and "subtype" not in data and data["type"] == "message":
-                        self.incoming_im(data)
-                time.sleep(1)
+                timeout = None
+                if config.PING_INTERVAL > 0:
+                    timeout = max(0, last_ping + config.PING_INTERVAL - time.time())
+
+                if self.slack.rtm_wait(timeout):
+                    #whatever is left over a batch keeps the socket readable for the next wait
+                    for data in self.slack.rtm_events(("message",), config.RTM_BATCH_SIZE):
+                        if "subtype" not in data:
+                            self.incoming_im(data)
+
+                if config.PING_INTERVAL > 0 and time.time() - last_ping >= config.PING_INTERVAL:
+                    self.slack.server.ping()
+                    last_ping = time.time()
         else:
             print("Slack connection failed...")
 
-    def get_user_info(self, data):
-        return self.slack.api_call("users.info", user=data["user"])
+    def run_async(self):
+        #add_reader is not available on the proactor loop Windows uses by default
+        loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.dispatch_async())
+        finally:
+            loop.close()
+
+    async def dispatch_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.aslack = AsyncSlackClient(self.api_key, user_cache_ttl=config.USER_CACHE_TTL, message_rate=config.SLACK_MESSAGE_RATE, \
+            pool_size=config.SLACK_POOL_SIZE)
+        self.slack = self.aslack.client
+
+        if not await self.aslack.rtm_connect(auto_reconnect=True):
+            print("Slack connection failed...")
+            return
+
+        print("Gabe is ready!")
+        await self.loop.run_in_executor(None, self.recover_builds)
+        async for data in self.aslack.rtm_events(config.PING_INTERVAL, ("message",), config.RTM_BATCH_SIZE):
+            if "subtype" not in data:
+                task = self.loop.create_task(self.incoming_im_async(data))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                task.add_done_callback(log_failure)
+
+    def recover_builds(self):
+        for data, text in self.builder.recover(self.store.get_data(), self.builder_callback, self.builder_group_callback):
+            self.send_msg(data, text)
 
     def incoming_im(self, data):
+        self.handle_message(data, self.slack.get_user(data["user"]))
+
+    async def incoming_im_async(self, data):
+        user = await self.aslack.get_user(data["user"])
+        #handlers touch git, disk and the store, keep them off the event loop
+        await self.loop.run_in_executor(None, self.handle_message, data, user)
+
+    def handle_message(self, data, user):
         text = data["text"].strip().replace("“", "\"").replace("”", "\"")
-        user_info = self.get_user_info(data)
-        if user_info["user"]["name"] == self.slack.server.username:
+        if user.name == self.slack.server.username:
             return
 
-        print ("%s: %s" % (user_info["user"]["name"], text))
+        print ("%s: %s" % (user.name, text))
 
         if text[:3].lower() == "add":
             self.incoming_add(data, text)
@@ -59,6 +141,14 @@ class Gaben:
             self.incoming_alter(data, text)
         elif text[:4].lower() == "jobs":
             self.incoming_jobs(data)
+        elif text[:4].lower() == "tail":
+            self.incoming_tail(data, text)
+        elif text[:5].lower() == "stats":
+            self.incoming_stats(data, text)
+        elif text[:7].lower() == "history":
+            self.incoming_history(data, text)
+        elif text[:6].lower() == "cancel":
+            self.incoming_cancel(data, text, user)
         else:
             if data["channel"] not in config.DONT_PRINT_USAGE_FOR:
                 self.send_usage(data)
@@ -70,7 +160,11 @@ remove - remove a project and clean it's data
 alter - change parameters of the project
 projects - get list of all projects
 build - build a project
-jobs - show current tasks and projects statuses""")
+jobs - show current tasks and projects statuses
+tail - show the latest output of a running build
+stats - show how long build stages take
+history - show recent builds of a project and how their time and size change
+cancel - stop running and queued builds of a project""")
 
     def send_msg(self, data, text):
         self.slack.rtm_send_message(data["channel"], text)
@@ -83,6 +177,8 @@ jobs - show current tasks and projects statuses""")
         parser.add_argument("--keystore_pwd", help="Keystore password", default="")
         parser.add_argument("--key", help="Keystore key", default="")
         parser.add_argument("--key_pwd", help="Keystore key password", default="")
+        parser.add_argument("--depth", type=int, help="Fetch only this many last commits, 0 fetches full history", default=-1)
+        parser.add_argument("--filter", help="Partial clone filter, e.g. blob:none, or none to fetch everything", default="")
     
         try:
             args = parser.parse_args(cmd)
@@ -96,8 +192,12 @@ jobs - show current tasks and projects statuses""")
                 project.key = args.key
             if len(args.key_pwd) > 0:
                 project.key_pwd = args.key_pwd
+            if args.depth >= 0:
+                project.fetch_depth = args.depth
+            if len(args.filter) > 0:
+                project.fetch_filter = "" if args.filter.lower() == "none" else args.filter
 
-            self.store.save()
+            self.store.update_project(project)
             self.send_msg(data, "Project altered")
 
         except Exception as ex:
@@ -115,6 +215,8 @@ jobs - show current tasks and projects statuses""")
         parser.add_argument("--key", help="Keystore key", default="")
         parser.add_argument("--key_pwd", help="Keystore key password", default="")
         parser.add_argument("--name", help="Name of the project (optional)", default="")
+        parser.add_argument("--depth", type=int, help="Fetch only this many last commits (default is full history)", default=0)
+        parser.add_argument("--filter", help="Partial clone filter, e.g. blob:none (default is none)", default="")
         
         try:
             args = parser.parse_args(cmd)
@@ -123,7 +225,7 @@ jobs - show current tasks and projects statuses""")
             if self.store.is_url_exists(args.url):
                 raise Exception("Project with url %s already exists" % args.url)
         
-            project = Project(args.url, args.keystore, args.keystore_pwd, args.key, args.key_pwd, args.name)
+            project = Project(args.url, args.keystore, args.keystore_pwd, args.key, args.key_pwd, args.name, args.depth, args.filter)
             self.store.add_project(project)
             self.send_msg(data, """Project added with parameters:
 *Url:* %s
@@ -132,7 +234,10 @@ jobs - show current tasks and projects statuses""")
 *Key:* %s
 *Key password:* %s
 *Name:* %s
-""" % (project.url, project.keystore_filename, project.keystore_pwd, project.key, project.key_pwd, project.name))
+*Fetch depth:* %s
+*Fetch filter:* %s
+""" % (project.url, project.keystore_filename, project.keystore_pwd, project.key, project.key_pwd, project.name, \
+    project.fetch_depth if project.fetch_depth > 0 else "full", project.fetch_filter if len(project.fetch_filter) > 0 else "none"))
         except Exception as ex:
            self.send_msg(data, str(ex))
 
@@ -156,7 +261,12 @@ jobs - show current tasks and projects statuses""")
         projects = self.store.get_data()
         result = ""
         for project in projects:
-            result += "*%s:* %s keystore=%s key=%s\r\n" % (project.name, project.url, project.keystore_filename, project.key)
+            result += "*%s:* %s keystore=%s key=%s" % (project.name, project.url, project.keystore_filename, project.key)
+            if project.fetch_depth > 0:
+                result += " depth=%d" % project.fetch_depth
+            if len(project.fetch_filter) > 0:
+                result += " filter=%s" % project.fetch_filter
+            result += "\r\n"
 
         if len(result) == 0:
             self.send_msg(data, "No projects added")
@@ -171,10 +281,11 @@ jobs - show current tasks and projects statuses""")
         parser = ArgumentParser(prog="build", description='Build the project')
         parser.add_argument("name", help="Name or url of the project")
         parser.add_argument("branch", help="Branch of the repositary")
-        parser.add_argument("platform", help="Platform: " + ",".join(platforms))
+        parser.add_argument("platform", help="Platform, several ones separated by commas are built in parallel: " + ",".join(platforms))
         parser.add_argument("--noupload", action="store_true", help="Don't upload build to Slack")
         parser.add_argument("--log", action="store_true", help="Always keep log, even if build was successful")
-        parser.add_argument("--clean", action="store_true", help="Make a clean build (remove unity cache)")
+        parser.add_argument("--clean", action="store_true", help="Make a clean build (remove all untracked files, Library is restored from cache)")
+        parser.add_argument("--nolibrary", action="store_true", help="Don't restore the Unity Library cache (use with --clean for a fully cold build)")
         parser.add_argument("--backend", help="Override scripting backend: " + ",".join(scripting_backengs), default="")
         parser.add_argument("--build", type=int, help="Override build number", default=-1)
         parser.add_argument("--version", help="Override build version", default="")
@@ -184,62 +295,325 @@ jobs - show current tasks and projects statuses""")
         parser.add_argument("--split", action="store_true", help="(Android only) Split APK & OBB (default is single APK)")
         parser.add_argument("--split_arch", action="store_true", help="(Android only) Split APK  by target architecture")
         parser.add_argument("--build_with_method", default="", help="Set custom building method")
+        parser.add_argument("--priority", type=int, default=0, help="Queue priority, higher builds start first (default is 0)")
+        parser.add_argument("--force", action="store_true", help="Build even if the same commit was already built with the same parameters")
         try:
             args = parser.parse_args(cmd)
             project = self.store.search(args.name)
-            if args.platform not in platforms:
-                raise Exception("Unknown platform %s. Possible options: %s" % (args.platform, ",".join(platforms)))
+            build_platforms = []
+            for platform in args.platform.split(","):
+                platform = platform.strip()
+                if platform not in platforms:
+                    raise Exception("Unknown platform %s. Possible options: %s" % (platform, ",".join(platforms)))
+                if platform not in build_platforms:
+                    build_platforms.append(platform)
             if args.backend not in scripting_backengs and len(args.backend) > 0:
                 raise Exception("Unknown scripting backend %s. Possible options: %s" % (args.backend, ",".join(scripting_backengs)))
-            if args.backend == "mono" and args.platform == "iOS":
-                raise Exception("%s backend doesn't work on platform %s" % (args.backend, args.platform))
-            self.builder.start(project, args.branch, args.platform, args.noupload, args.backend, not args.donotsign, \
-                    args.split, args.split_arch, args.log, args.clean, args.build, args.version, args.development, args.profiler, args.build_with_method, data, self.builder_callback)
-            self.send_msg(data, config.get_random_quote())
+            if args.backend == "mono" and "iOS" in build_platforms:
+                raise Exception("%s backend doesn't work on platform %s" % (args.backend, "iOS"))
+
+            group = None
+            if len(build_platforms) == 1:
+                callbacks = {build_platforms[0]: self.builder_callback}
+            else:
+                group = BuildGroup(build_platforms, self.builder_group_callback)
+                callbacks = {platform: group for platform in build_platforms}
+
+            queued = []
+            failed = []
+            requested_at = time.time()
+            for platform in build_platforms:
+                try:
+                    position = self.builder.start(project, args.branch, platform, args.noupload, args.backend, not args.donotsign, \
+                        args.split, args.split_arch, args.log, args.clean, args.build, args.version, args.development, args.profiler, args.build_with_method, data, callbacks[platform], args.priority, args.force, not args.nolibrary, requested_at)
+                except Exception as ex:
+                    if group is None:
+                        raise
+                    #the platforms started already report to the group, it must not wait for this one
+                    group.forget(platform)
+                    failed.append("%s: %s" % (platform, str(ex)))
+                    continue
+                if position > 0:
+                    queued.append("%s at position %d" % (platform, position))
+
+            if len(failed) > 0:
+                self.send_msg(data, "Failed to start builds of *%s*: %s" % (project.name, "; ".join(failed)))
+                if len(failed) == len(build_platforms):
+                    return
+
+            if len(build_platforms) == 1 and len(queued) > 0:
+                self.send_msg(data, "Build of *%s* queued at position %d" % (project.name, position))
+            elif len(queued) > 0:
+                self.send_msg(data, "Builds of *%s* started, queued: %s" % (project.name, ", ".join(queued)))
+            else:
+                self.send_msg(data, config.get_random_quote())
         except Exception as ex:
             self.send_msg(data, str(ex))
             return
             
     def incoming_jobs(self, data):
         jobs = self.builder.get_jobs()
-        if len(jobs) == 0:
+        queue = self.builder.get_queue()
+        if len(jobs) == 0 and len(queue) == 0:
             self.send_msg(data, "No jobs at the moment (uploading your build is not a job)")
             return
         result = "*Current jobs:*\r\n"
         for job in jobs:
-            result += "*%s* -> %s\r\n" % (job.project.name, str(job.pipeline.get_current_job()) if job.pipeline is not None else "Finishing")
+            result += "*%s* (%s, %s) -> %s\r\n" % (job.project.name, job.platform, job.branch, job.get_status())
+        if len(queue) > 0:
+            result += "*Queued:*\r\n"
+            for position, job in enumerate(queue):
+                result += "%d. *%s* (%s, %s)\r\n" % (position + 1, job.project.name, job.platform, job.branch)
         self.send_msg(data, result)
 
-    def builder_callback(self, data, project, status, file_path, noupload):
+    def incoming_tail(self, data, text):
+        cmd = shlex.split(text)[1:]
+        parser = ArgumentParser(prog="tail", description='Show the latest output of a running build')
+        parser.add_argument("name", help="Name or url of the project")
+        parser.add_argument("--lines", type=int, help="Number of lines to show (default is 20)", default=20)
+
+        try:
+            args = parser.parse_args(cmd)
+            project = self.store.search(args.name)
+            result = ""
+            for job in self.builder.get_jobs():
+                if job.project.url.lower() != project.url.lower() or job.pipeline is None:
+                    continue
+                result += "*%s* (%s) -> %s\r\n```%s```\r\n" % (job.project.name, job.platform, str(job.pipeline.get_current_job()), job.pipeline.get_tail(args.lines))
+            if len(result) == 0:
+                raise Exception("Project *%s* is not building right now" % project.name)
+            self.send_msg(data, result)
+        except Exception as ex:
+            self.send_msg(data, str(ex))
+
+    def incoming_stats(self, data, text):
+        cmd = shlex.split(text)[1:]
+        parser = ArgumentParser(prog="stats", description='Show p50/p95 durations of build stages')
+        parser.add_argument("name", nargs="?", help="Name or url of the project, all projects if omitted", default=None)
+
+        try:
+            args = parser.parse_args(cmd)
+            name = self.store.search(args.name).name if args.name is not None else None
+            rows = []
+            for labels, (p50, p95), count in self.builder.metrics.get_percentiles("gaben_stage_seconds"):
+                if name is None or labels["project"] == name:
+                    rows.append((labels["project"], labels["stage"], p50, p95, count))
+            if len(rows) == 0:
+                raise Exception("No builds finished since Gaben started")
+
+            rows.sort()
+            result = "*Stage durations:*\r\n```%-20s %-8s %9s %9s  %s\r\n" % ("project", "stage", "p50", "p95", "(samples)")
+            for project, stage, p50, p95, count in rows:
+                result += "%-20s %-8s %8.1fs %8.1fs  (%d)\r\n" % (project, stage, p50, p95, count)
+            cache = self.slack.server.user_cache.stats()
+            result += "```\r\nUploads waiting: %d, messages waiting: %d, user cache: %d hits / %d misses" % \
+                (self.uploader.get_pending(), self.slack.server.outbox.depth(), cache["hits"], cache["misses"])
+            self.send_msg(data, result)
+        except Exception as ex:
+            self.send_msg(data, str(ex))
+
+    def incoming_cancel(self, data, text, user):
+        cmd = shlex.split(text)[1:]
+        parser = ArgumentParser(prog="cancel", description='Stop running and queued builds of a project')
+        parser.add_argument("name", help="Name or url of the project")
+        parser.add_argument("--platform", help="Only builds of this platform", default=None)
+
+        try:
+            args = parser.parse_args(cmd)
+            project = self.store.search(args.name)
+            queued, running = self.builder.cancel(project, args.platform, "Cancelled by %s" % user.name)
+            if queued + running == 0:
+                raise Exception("Project *%s* has no running or queued builds" % project.name)
+            self.send_msg(data, "Cancelling *%s*: %d running, %d queued" % (project.name, running, queued))
+        except Exception as ex:
+            self.send_msg(data, str(ex))
+
+    def incoming_history(self, data, text):
+        cmd = shlex.split(text)[1:]
+        parser = ArgumentParser(prog="history", description='Show recent builds and weekly build time and size trends')
+        parser.add_argument("name", help="Name or url of the project")
+        parser.add_argument("--platform", help="Only builds of this platform", default=None)
+        parser.add_argument("--limit", type=int, help="Number of recent builds to show (default is 10)", default=10)
+        parser.add_argument("--weeks", type=int, help="Number of weeks in the trend (default is 4)", default=4)
+
+        try:
+            args = parser.parse_args(cmd)
+            project = self.store.search(args.name)
+            history = self.builder.history
+            builds = history.get_recent(project.name, args.platform, args.limit)
+            if len(builds) == 0:
+                raise Exception("No builds of *%s* recorded yet" % project.name)
+
+            result = "*Recent builds of %s:*\r\n```" % project.name
+            for b in builds:
+                result += "%s %-8s %-15s %-8s %-7s %8s %10s\r\n" % (time.strftime("%Y-%m-%d %H:%M", time.localtime(b["finished_at"])), \
+                    b["platform"], b["branch"][:15], (b["commit_hash"] or "")[:8], b["status"], format_duration(b["duration"]), format_size(b["artifact_size"]))
+            result += "```\r\n"
+
+            trend = history.get_trend(project.name, args.platform, args.weeks)
+            if len(trend) > 0:
+                result += "*Successful builds per week (0 is the last 7 days):*\r\n```"
+                for t in trend:
+                    result += "%-8s week %d: %3d builds, %8s avg, %10s avg\r\n" % (t["platform"], t["week"], t["builds"], \
+                        format_duration(t["duration"]), format_size(t["artifact_size"]))
+                for t in history.get_stage_trend(project.name, args.platform, args.weeks):
+                    result += "%-8s week %d: %8s avg (stage)\r\n" % (t["stage"], t["week"], format_duration(t["seconds"]))
+                result += "```"
+            self.send_msg(data, result)
+        except Exception as ex:
+            self.send_msg(data, str(ex))
+
+    def builder_progress(self, data, project, platform, text):
+        #one message per request and platform, edited in place as the build goes
+        key = (data["channel"], data.get("ts"), platform)
+        with self.progress_lock:
+            posting = key not in self.progress_messages
+            ts = self.progress_messages.setdefault(key, None)
+        if posting:
+            #while the message is being posted the other updates are skipped, instead of posting another one
+            result = {}
+            try:
+                result = self.slack.api_call("chat.postMessage", channel=data["channel"], text=text, as_user=True)
+            finally:
+                with self.progress_lock:
+                    if result.get("ok"):
+                        self.progress_messages[key] = result["ts"]
+                    else:
+                        self.progress_messages.pop(key, None)
+        elif ts is not None:
+            self.slack.api_call("chat.update", channel=data["channel"], ts=ts, text=text)
+
+    def forget_progress(self, data, platform):
+        with self.progress_lock:
+            self.progress_messages.pop((data["channel"], data.get("ts"), platform), None)
+
+    def builder_callback(self, data, project, platform, status, file_path, noupload):
+        #called on the pipeline thread, the upload worker takes it from here in both dispatch modes,
+        #so UPLOAD_CONCURRENCY and the upload queue apply to every build
+        self.uploader.put(self.deliver_build, data, project, platform, status, file_path, noupload)
+
+    def deliver_build(self, data, project, platform, status, file_path, noupload):
+        try:
+            if not self.check_upload(data, file_path, noupload):
+                return
+
+            try:
+                started = time.time()
+                self.slack.upload_file(data["channel"], file_path, progress=self.get_upload_progress(data, project, platform, file_path), throttle=self.upload_throttle)
+                self.builder.metrics.observe("gaben_stage_seconds", time.time() - started, project=project.name, stage="upload")
+            except Exception as ex:
+                print("Failed to upload file to slack: %s" % str(ex))
+                self.send_msg(data, "Failed to upload build to Slack, grab it %s" % self.get_location(file_path))
+                return
+
+            self.send_build_status(data, project, status)
+        finally:
+            self.forget_progress(data, platform)
+            self.builder.release_delivery(file_path)
+
+    def builder_group_callback(self, data, project, results):
+        #called on the pipeline thread of the last platform to finish
+        self.uploader.put(self.deliver_group, data, project, results)
+
+    def deliver_group(self, data, project, results):
+        try:
+            lines = []
+            for platform, status, file_path, noupload in results:
+                if status:
+                    line = ":+1: *%s* completed" % platform
+                else:
+                    line = ":octagonal_sign: *%s* failed" % platform
+                lines.append("%s, %s" % (line, self.deliver_file(data, project, platform, file_path, noupload)))
+            self.send_msg(data, "Builds of *%s* finished:\n%s" % (project.name, "\n".join(lines)))
+        finally:
+            for platform, status, file_path, noupload in results:
+                self.forget_progress(data, platform)
+                self.builder.release_delivery(file_path)
+
+    def deliver_file(self, data, project, platform, file_path, noupload):
+        """Uploads one build of a group, returns how it was delivered for the summary"""
+        MAX_MB = config.MAX_UPLOAD_SIZE_MB
+        if noupload:
+            return "grab it %s" % self.get_location(file_path)
+        if os.path.getsize(file_path) > 1024*1024*MAX_MB:
+            return "exceeds %dMb, grab it %s" % (MAX_MB, self.get_location(file_path))
+        try:
+            started = time.time()
+            self.slack.upload_file(data["channel"], file_path, progress=self.get_upload_progress(data, project, platform, file_path), throttle=self.upload_throttle)
+            self.builder.metrics.observe("gaben_stage_seconds", time.time() - started, project=project.name, stage="upload")
+        except Exception as ex:
+            print("Failed to upload file to slack: %s" % str(ex))
+            return "upload failed, grab it %s" % self.get_location(file_path)
+        return "uploaded %s" % os.path.basename(file_path)
+
+    def get_upload_progress(self, data, project, platform, file_path):
+        #reports every quarter of the file in the build's progress message
+        name = os.path.basename(file_path)
+        reported = [0]
+
+        def progress(sent, total):
+            percent = 100 * sent // total if total > 0 else 100
+            if percent < 100 and percent - reported[0] < 25:
+                return
+            reported[0] = percent
+            try:
+                self.builder_progress(data, project, platform, "Uploading *%s*: %d%%" % (name, percent))
+            except Exception as ex:
+                print("Failed to report upload progress: %s" % str(ex))
+        return progress
+
+    def check_upload(self, data, file_path, noupload):
         size = os.path.getsize(file_path)
         MAX_MB = config.MAX_UPLOAD_SIZE_MB
         if noupload:
-            self.send_msg(data, "Build completed! No upload flag is set, so grab your build locally in %s" % file_path)
-            return
+            self.send_msg(data, "Build completed! No upload flag is set, so grab your build %s" % self.get_location(file_path))
+            return False
 
         if size > 1024*1024*MAX_MB:
-            self.send_msg(data, "Build completed, but it's exceeds %dMb size! :neutral_face:\nYou can grab build locally in %s" % (MAX_MB, file_path))
-            return
+            self.send_msg(data, "Build completed, but it's exceeds %dMb size! :neutral_face:\nYou can grab build %s" % (MAX_MB, self.get_location(file_path)))
+            return False
 
-        try:
-            with open(file_path, "rb") as f:
-                self.slack.api_call(
-                    'files.upload', 
-                    channels=data["channel"], 
-                    as_user=True, 
-                    filename=os.path.basename(file_path), 
-                    file=f,
-                )
-        except Exception as ex:
-            print("Failed to upload file to slack: %s" % str(ex))
-            self.send_msg(data, "Failed to upload build to Slack, grab the build locally in %s" % file_path)
-            return
+        return True
 
+    def get_location(self, file_path):
+        #the message points at the file, so it has to outlive the link
+        self.builder.keep_delivery(file_path, config.ARTIFACT_LINK_TTL_HOURS * 3600)
+        link = self.artifact_server.get_link(file_path)
+        if link is not None:
+            return "here: %s" % link
+        return "locally in %s" % file_path
+
+    def send_build_status(self, data, project, status):
         if status:
             self.send_msg(data, "Build of %s completed! :+1:" % project.name)
         else:
             self.send_msg(data, ":octagonal_sign: Build of %s failed! " % project.name)
     
 
+def log_failure(future):
+    """Done callback printing what an async handler died of, nothing else would"""
+    if future.cancelled() or future.exception() is None:
+        return
+    ex = future.exception()
+    print("Async handler failed: %s" % str(ex))
+    traceback.print_exception(type(ex), ex, ex.__traceback__)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    return "%dm %02ds" % (seconds // 60, seconds % 60)
+
+
+def format_size(size):
+    if size is None:
+        return "-"
+    return "%.1f MB" % (size / 1024.0 / 1024.0)
+
+
 if __name__ == "__main__":
-    Gaben(config.API_KEY, config.REP_DIRECTORY).run()
\ No newline at end of file
+    gaben = Gaben(config.API_KEY, config.REP_DIRECTORY)
+    if config.ASYNC_DISPATCHER:
+        gaben.run_async()
+    else:
+        gaben.run()
\ No newline at end of file
@@ -0,0 +1,101 @@
+from contextlib import closing
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class BuildHistory:
+    """Finished builds in a SQLite database, so build times and sizes can be compared over weeks"""
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS builds (
+            id TEXT PRIMARY KEY,
+            project TEXT NOT NULL,
+            url TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            commit_hash TEXT,
+            unity_version TEXT,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            failed_job TEXT,
+            started_at REAL NOT NULL,
+            finished_at REAL NOT NULL,
+            duration REAL NOT NULL,
+            artifact_size INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS stages (
+            build_id TEXT NOT NULL REFERENCES builds(id) ON DELETE CASCADE,
+            stage TEXT NOT NULL,
+            seconds REAL NOT NULL,
+            PRIMARY KEY (build_id, stage)
+        )""",
+        "CREATE INDEX IF NOT EXISTS builds_project ON builds (project, finished_at)",
+        "CREATE INDEX IF NOT EXISTS builds_platform ON builds (project, platform, finished_at)",
+        "CREATE INDEX IF NOT EXISTS stages_stage ON stages (stage)",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if len(directory) > 0 and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with closing(self.connect()) as db, db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    def connect(self):
+        #the connection only commits as a context manager, callers close it with closing()
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, build_id, project, url, branch, platform, commit, unity_version, params, status, failed_job, \
+            started_at, finished_at, artifact_size, stages):
+        with self.lock, closing(self.connect()) as db, db:
+            db.execute("INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+                (build_id, project, url, branch, platform, commit, unity_version, json.dumps(params, sort_keys=True), status, \
+                failed_job, started_at, finished_at, finished_at - started_at, artifact_size))
+            db.executemany("INSERT OR REPLACE INTO stages VALUES (?, ?, ?)", [(build_id, stage, seconds) for stage, seconds in stages.items()])
+
+    def get_recent(self, project, platform=None, limit=10):
+        query = "SELECT * FROM builds WHERE project = ?"
+        args = [project]
+        if platform is not None:
+            query += " AND platform = ?"
+            args.append(platform)
+        query += " ORDER BY finished_at DESC LIMIT ?"
+        args.append(limit)
+        with closing(self.connect()) as db, db:
+            return [dict(row) for row in db.execute(query, args)]
+
+    def get_trend(self, project, platform=None, weeks=4):
+        """Returns per platform and week (0 is the last 7 days) the count, average duration and size of successful builds"""
+        now = time.time()
+        query = "SELECT platform, CAST((? - finished_at) / 604800 AS INTEGER) AS week, COUNT(*) AS builds, " \
+            "AVG(duration) AS duration, AVG(artifact_size) AS artifact_size FROM builds " \
+            "WHERE project = ? AND status = 'success' AND finished_at > ?"
+        args = [now, project, now - weeks * 604800]
+        if platform is not None:
+            query += " AND platform = ?"
+            args.append(platform)
+        query += " GROUP BY platform, week ORDER BY platform, week DESC"
+        with closing(self.connect()) as db, db:
+            return [dict(row) for row in db.execute(query, args)]
+
+    def get_stage_trend(self, project, platform=None, weeks=4):
+        """Returns per stage and week the average seconds spent in it by successful builds"""
+        now = time.time()
+        query = "SELECT s.stage AS stage, CAST((? - b.finished_at) / 604800 AS INTEGER) AS week, AVG(s.seconds) AS seconds " \
+            "FROM stages s JOIN builds b ON b.id = s.build_id " \
+            "WHERE b.project = ? AND b.status = 'success' AND b.finished_at > ?"
+        args = [now, project, now - weeks * 604800]
+        if platform is not None:
+            query += " AND b.platform = ?"
+            args.append(platform)
+        query += " GROUP BY stage, week ORDER BY stage, week DESC"
+        with closing(self.connect()) as db, db:
+            return [dict(row) for row in db.execute(query, args)]
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+
+
+class BuildJournal:
+    """Append-only log of build requests and pipeline progress, replayed on startup to recover interrupted builds"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, event, build_id, **fields):
+        record = dict(fields)
+        record["event"] = event
+        record["id"] = build_id
+        line = json.dumps(record)
+
+        with self.lock:
+            try:
+                directory = os.path.dirname(self.path)
+                if len(directory) > 0 and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(self.path, "a") as f:
+                    f.write(line + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as ex:
+                print("Failed to write build journal: %s" % str(ex))
+
+    def read(self):
+        records = []
+        if not os.path.isfile(self.path):
+            return records
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    #torn write from a crash, nothing after it can be trusted either
+                    break
+        return records
+
+    def load_pending(self):
+        """Returns builds that were queued or running when Gaben stopped, in request order"""
+        builds = {}
+        order = []
+        for record in self.read():
+            build_id = record["id"]
+            event = record["event"]
+            if event == "queued":
+                builds[build_id] = {"id": build_id, "project_url": record["project_url"], "params": record["params"], \
+                    "priority": record["priority"], "requesters": record["requesters"], \
+                    "groups": record.get("groups", [None] * len(record["requesters"])), "started": False, "jobs": [], "pids": []}
+                order.append(build_id)
+            elif build_id not in builds:
+                continue
+            elif event == "requester":
+                builds[build_id]["requesters"].append(record["data"])
+                builds[build_id]["groups"].append(record.get("group"))
+            elif event == "started":
+                builds[build_id]["started"] = True
+            elif event == "job":
+                builds[build_id]["jobs"].append(record["job"])
+            elif event == "pid":
+                builds[build_id]["pids"].append((record["pid"], record["executable"]))
+            elif event == "finished":
+                del builds[build_id]
+
+        return [builds[build_id] for build_id in order if build_id in builds]
+
+    def compact(self):
+        """Drops the records of finished builds"""
+        with self.lock:
+            if not os.path.isfile(self.path):
+                return
+            pending = set()
+            records = []
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    records.append(record)
+                    if record["event"] == "queued":
+                        pending.add(record["id"])
+                    elif record["event"] == "finished":
+                        pending.discard(record["id"])
+
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                for record in records:
+                    if record["id"] in pending:
+                        f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
@@ -0,0 +1,155 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bisect
+import threading
+import collections
+
+
+class Metrics:
+    """In-memory counters and histograms, rendered in the Prometheus text format"""
+    BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+    SAMPLES = 500
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = {}
+        self.help = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_max(self, name, value, **labels):
+        """Gauge keeping the highest value seen, e.g. peak memory"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = max(self.gauges.get(key, 0), value)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0, \
+                    "samples": collections.deque(maxlen=self.SAMPLES)}
+                self.histograms[key] = histogram
+            index = bisect.bisect_left(self.BUCKETS, value)
+            if index < len(self.BUCKETS):
+                histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+            histogram["samples"].append(value)
+
+    def register(self, name, type_, collect, help_=""):
+        """Adds a value read at render time, `collect` returns a number"""
+        with self.lock:
+            self.collectors[name] = (type_, collect)
+            if len(help_) > 0:
+                self.help[name] = help_
+
+    def get_percentiles(self, name, percentiles=(50, 95)):
+        """Returns (labels, [value per percentile], sample count) for each series of a histogram, over its recent samples"""
+        result = []
+        with self.lock:
+            items = [(dict(labels), sorted(h["samples"])) for (n, labels), h in self.histograms.items() if n == name]
+        for labels, samples in items:
+            if len(samples) == 0:
+                continue
+            values = [samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] for p in percentiles]
+            result.append((labels, values, len(samples)))
+        return result
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((k, dict(v, buckets=list(v["buckets"]))) for k, v in self.histograms.items())
+            collectors = sorted(self.collectors.items())
+
+        typed = set()
+        def declare(name, type_):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, type_))
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+        for (name, labels), value in gauges:
+            declare(name, "gauge")
+            lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+        for (name, labels), histogram in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", format_value(bound)),)), cumulative))
+            lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", "+Inf"),)), histogram["count"]))
+            lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(histogram["sum"])))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), histogram["count"]))
+        for name, (type_, collect) in collectors:
+            try:
+                value = collect()
+            except Exception as ex:
+                print("Failed to collect metric %s: %s" % (name, str(ex)))
+                continue
+            declare(name, type_)
+            lines.append("%s %s" % (name, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves Metrics.render() on /metrics"""
+    def __init__(self, metrics, host, port):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+
+    def is_enabled(self):
+        return self.port > 0
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        #request threads must not keep Gaben from exiting
+        self.httpd.daemon_threads = True
+        thread = threading.Thread(target=httpd.serve_forever, name="metrics-server")
+        thread.daemon = True
+        thread.start()
+        print("Metrics are served on %s:%d/metrics" % (self.host, self.port))
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels]
+    return "{%s}" % ",".join(escaped)
+
+
+def format_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
@@ -1 +1,2 @@
 from .client import SlackClient # noqa
+from .aio import AsyncSlackClient # noqa
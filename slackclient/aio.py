@@ -0,0 +1,138 @@
+import asyncio
+import functools
+
+from .client import SlackClient
+
+
+class AsyncSlackClient(object):
+    '''
+    asyncio front-end for SlackClient.
+
+    Web API calls run on the event loop's executor so a slow `users.info` or a large
+    `files.upload` doesn't hold up other coroutines, and RTM events are delivered through
+    an async iterator that sleeps on the websocket with `loop.add_reader` instead of polling.
+
+    The reader needs a selector based event loop (on Windows create a
+    `asyncio.SelectorEventLoop` explicitly, the default proactor loop has no `add_reader`).
+
+    Init:
+        :Args:
+            token (str): Your Slack Authentication token
+            proxies (dict): Proxies to use, see SlackClient
+            executor (concurrent.futures.Executor): Executor for blocking calls, the loop's
+            default executor if None
+            user_cache_ttl (float): Seconds a looked up user stays cached, see SlackClient
+            message_rate (float): RTM messages sent per second to a channel, see SlackClient
+            pool_size (int): Web API connections kept alive for reuse, see SlackClient
+    '''
+    def __init__(self, token, proxies=None, executor=None, user_cache_ttl=3600, message_rate=1.0, pool_size=10):
+        self.client = SlackClient(token, proxies, user_cache_ttl, message_rate=message_rate, pool_size=pool_size)
+        self.executor = executor
+
+    @property
+    def server(self):
+        return self.client.server
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def rtm_connect(self, with_team_state=True, **kwargs):
+        '''
+        Connects to the RTM Websocket, see SlackClient.rtm_connect
+        '''
+        return await self._run(self.client.rtm_connect, with_team_state, **kwargs)
+
+    async def api_call(self, method, timeout=None, **kwargs):
+        '''
+        Call the Slack Web API without blocking the event loop, see SlackClient.api_call
+        '''
+        return await self._run(self.client.api_call, method, timeout=timeout, **kwargs)
+
+    async def upload_file(self, channel, file_path, **kwargs):
+        '''
+        Streams a file to Slack without blocking the event loop, see SlackClient.upload_file
+        '''
+        return await self._run(self.client.upload_file, channel, file_path, **kwargs)
+
+    async def get_user(self, user_id):
+        '''
+        Returns the User for `user_id`, going to the Web API only on a cache miss
+        '''
+        user = self.server.user_cache.get(user_id)
+        if user is not None:
+            return user
+        return await self._run(self.client.fetch_user, user_id)
+
+    def rtm_send_message(self, channel, message, thread=None, reply_broadcast=None):
+        '''
+        Sends a message to a given channel, see SlackClient.rtm_send_message
+        '''
+        return self.client.rtm_send_message(channel, message, thread, reply_broadcast)
+
+    async def rtm_events(self, ping_interval=None, types=None, max_batch=None):
+        '''
+        Async iterator over incoming RTM events.
+
+        :Args:
+            ping_interval (float or None) - send an RTM ping after this many idle seconds
+            types (iterable or None) - only yield events of these types, see SlackClient.rtm_events
+            max_batch (int or None) - frames read before giving the event loop a turn
+
+        Example::
+
+            async for event in client.rtm_events(30):
+                print(event)
+        '''
+        loop = asyncio.get_running_loop()
+        last_ping = loop.time()
+        while True:
+            # Reading may reconnect, which sleeps between attempts, so it runs on the executor
+            events = await self._run(lambda: list(self.client.rtm_events(types, max_batch)))
+            count = len(events)
+            for data in events:
+                yield data
+            if max_batch and count >= max_batch:
+                # More may be waiting, let other tasks run before reading on
+                await asyncio.sleep(0)
+                continue
+
+            timeout = None
+            if ping_interval:
+                timeout = max(0, last_ping + ping_interval - loop.time())
+            await self._wait_readable(timeout)
+
+            if ping_interval and loop.time() - last_ping >= ping_interval:
+                self.server.ping()
+                last_ping = loop.time()
+
+    async def _wait_readable(self, timeout):
+        websocket = self.server.websocket
+        sock = websocket.sock if websocket is not None else None
+        if sock is None:
+            await asyncio.sleep(timeout if timeout is not None else 1)
+            return
+
+        # Bytes already decrypted by the SSL layer won't wake the selector
+        pending = getattr(sock, "pending", None)
+        if pending is not None and pending() > 0:
+            return
+
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def on_readable():
+            if not readable.done():
+                readable.set_result(True)
+
+        fd = sock.fileno()
+        if fd < 0:
+            # Closed under us, let rtm_read handle the reconnection
+            return
+        loop.add_reader(fd, on_readable)
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(fd)
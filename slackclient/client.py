@@ -2,10 +2,28 @@
 # mostly a proxy object to abstract how some of this works
 
 import json
+import os
+import random
+import time
 import traceback
 
+import requests
+
 from .server import Server
-from .exceptions import ParseResponseError
+from .exceptions import ParseResponseError, SlackClientError
+from .slackrequest import parse_retry_after
+
+# Incoming events are decoded with the fastest JSON library available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
+# Events process_changes keeps the workspace state with, never filtered out
+STATE_EVENT_TYPES = ('channel_created', 'group_joined', 'im_created', 'team_join', 'user_change')
 
 
 class SlackClient(object):
@@ -26,11 +44,15 @@ class SlackClient(object):
             proxies (dict): Proxies to use when create websocket or api calls,
             declare http and websocket proxies using {'http': 'http://127.0.0.1'},
             and https proxy using {'https': 'https://127.0.0.1:443'}
+            user_cache_ttl (float): Seconds a looked up user stays cached, 0 never expires
+            base_url (str): Web API root to use instead of https://slack.com/api/
+            message_rate (float): RTM messages sent per second to a channel, 0 disables the limit
+            pool_size (int): Web API connections kept alive for reuse
     '''
-    def __init__(self, token, proxies=None):
+    def __init__(self, token, proxies=None, user_cache_ttl=3600, base_url=None, message_rate=1.0, pool_size=10):
 
         self.token = token
-        self.server = Server(self.token, False, proxies)
+        self.server = Server(self.token, False, proxies, user_cache_ttl, base_url, message_rate, pool_size)
 
     def append_user_agent(self, name, version):
         self.server.append_user_agent(name, version)
@@ -100,10 +122,128 @@ class SlackClient(object):
                 self.server.parse_channel_data([result['channel']])
         return result
 
+    def upload_file(self, channel, file_path, filename=None, title=None, progress=None, retries=5, timeout=None, throttle=None):
+        '''
+        Uploads a file with Slack's external upload flow (`files.getUploadURLExternal`, a raw
+        POST of the file, `files.completeUploadExternal`). The file is streamed from disk, so
+        memory use doesn't depend on its size.
+
+        Each step is retried on its own after 5xx responses, the transfer also after rate
+        limiting (honoring Retry-After) and connection errors, so a failed transfer is retried
+        against the same upload URL without starting the flow over. Rate limiting and failures
+        to connect of the Web API steps are retried by SlackRequest.
+
+        :Args:
+            channel (str) - channel id to share the file to
+            file_path (str) - path of the file to upload
+            filename (str) - name shown in Slack, the file's own name by default
+            title (str) - title shown in Slack, the filename by default
+            progress (callable) - called with (bytes_sent, total_bytes) during the transfer
+            retries (int) - attempts per step before giving up
+            timeout (float) - stop waiting for a single response after this many seconds
+            throttle (Throttle) - bandwidth limit for the transfer, see slackrequest.Throttle
+
+        :Returns:
+            dict -- the `files.completeUploadExternal` response
+
+        :Raises:
+            SlackClientError if a step keeps failing
+        '''
+        filename = filename or os.path.basename(file_path)
+        length = os.path.getsize(file_path)
+
+        ticket = self._api_call_with_retry(retries, "files.getUploadURLExternal", timeout=timeout, filename=filename, length=length)
+
+        def transfer():
+            with open(file_path, "rb") as f:
+                return self.server.api_requester.post_file(ticket["upload_url"], f, length, progress, timeout=timeout, throttle=throttle)
+        self._with_retry(retries, transfer)
+
+        files = [{"id": ticket["file_id"], "title": title or filename}]
+        return self._api_call_with_retry(retries, "files.completeUploadExternal", timeout=timeout, files=files, channel_id=channel)
+
+    def _api_call_with_retry(self, retries, method, timeout=None, **kwargs):
+        def attempt():
+            try:
+                result = self.api_call(method, timeout=timeout, **kwargs)
+            except ParseResponseError:
+                # Proxies and load balancers answer 5xx with html
+                return None, None
+            if result.get("ok"):
+                return result, None
+            # Still rate limited after SlackRequest's own retries, ends here like any other error
+            raise SlackClientError("%s failed: %s" % (method, result.get("error")))
+        # A call lost after it was sent may have gone through, completeUploadExternal would share twice
+        return self._retry(retries, attempt, method, retry_errors=())
+
+    def _with_retry(self, retries, send):
+        def attempt():
+            response = send()
+            if response.status_code == 200:
+                return response, None
+            if response.status_code == 429:
+                return None, response.headers.get("Retry-After")
+            if response.status_code >= 500:
+                return None, None
+            raise SlackClientError("Upload failed with HTTP %d: %s" % (response.status_code, response.text[:200]))
+        return self._retry(retries, attempt, "upload")
+
+    def _retry(self, retries, attempt, name, retry_errors=(requests.RequestException,)):
+        # `attempt` returns (result, None) on success, (None, retry_after or None) to retry
+        # and raises SlackClientError on errors that won't go away by retrying, or one of
+        # `retry_errors` to retry
+        last_error = "server error"
+        for i in range(retries):
+            try:
+                result, retry_after = attempt()
+                if result is not None:
+                    return result
+                last_error = "rate limited" if retry_after is not None else "server error"
+            except retry_errors as ex:
+                retry_after = None
+                last_error = str(ex)
+            if i == retries - 1:
+                break
+            if retry_after is not None:
+                delay = parse_retry_after(retry_after, 1)
+            else:
+                delay = min(60, 2 ** i) + random.random()
+            time.sleep(delay)
+        raise SlackClientError("%s failed after %d attempts: %s" % (name, retries, last_error))
+
+    def get_user(self, user_id):
+        '''
+        Returns the User for `user_id`, asking the Web API (`users.info`) only when the
+        user isn't in the cache or its entry has expired.
+
+        :Args:
+            user_id (str) - Slack user id, e.g. 'UABC1234'
+
+        :Returns:
+            User
+
+        :Raises:
+            SlackClientError if `users.info` fails
+        '''
+        user = self.server.user_cache.get(user_id)
+        if user is not None:
+            return user
+        return self.fetch_user(user_id)
+
+    def fetch_user(self, user_id):
+        '''
+        Looks up `user_id` with `users.info`, bypassing and then refreshing the user cache.
+        '''
+        result = self.api_call("users.info", user=user_id)
+        if not result.get("ok"):
+            raise SlackClientError("users.info failed for %s: %s" % (user_id, result.get("error")))
+        self.server.parse_user_data([result["user"]])
+        return self.server.users[user_id]
+
     def rtm_read(self):
         '''
-        Reads from the RTM Websocket stream then calls `self.process_changes(item)` for each line
-        in the returned data.
+        Reads from the RTM Websocket stream then calls `self.process_changes(item)` for each
+        event in the returned data.
 
         Multiple events may be returned, always returns a list [], which is empty if there are no
         incoming messages.
@@ -119,17 +259,64 @@ class SlackClient(object):
         :Raises:
             SlackNotConnected if self.server is not defined.
         '''
-        # in the future, this should handle some events internally i.e. channel
-        # creation
+        return list(self.rtm_events())
+
+    def rtm_events(self, types=None, max_batch=None):
+        '''
+        Yields one decoded event per RTM websocket frame that is already available, calling
+        `self.process_changes(item)` for each. Stops when no more data can be read without
+        blocking.
+
+        :Args:
+            types (iterable or None) - only decode and yield events of these types, e.g.
+            ('message',). Other frames are dropped by a substring test on their raw text, which
+            skips the JSON parsing of the presence and typing events a bot gets the most of.
+            Events needed for the workspace state are always processed
+            max_batch (int or None) - read at most this many frames, None reads until no data
+            is left
+
+        Example::
+
+            for event in sc.rtm_events(('message',), 100):
+                print(event['text'])
+
+        :Raises:
+            SlackNotConnected if self.server is not defined.
+        '''
+        if not self.server:
+            raise SlackNotConnected
+        needles = None
+        if types is not None:
+            types = set(types)
+            needles = []
+            for type_ in types.union(STATE_EVENT_TYPES):
+                needles.append('"type":"%s"' % type_)
+                needles.append('"type": "%s"' % type_)
+
+        for frame in self.server.websocket_frames(max_batch):
+            if needles is not None and not any(needle in frame for needle in needles):
+                continue
+            item = json_loads(frame)
+            self.process_changes(item)
+            if types is None or item.get("type") in types:
+                yield item
+
+    def rtm_wait(self, timeout=None):
+        '''
+        Blocks until the RTM websocket has incoming data or `timeout` seconds pass, so
+        callers can sleep instead of polling `rtm_read`.
+
+        :Args:
+            timeout (float or None) - maximum time to wait, None waits forever
+
+        :Returns:
+            True if `rtm_read` should be called, False on timeout
+
+        :Raises:
+            SlackNotConnected if self.server is not defined.
+        '''
         if self.server:
-            json_data = self.server.websocket_safe_read()
-            data = []
-            if json_data != '':
-                for d in json_data.split('\n'):
-                    data.append(json.loads(d))
-            for item in data:
-                self.process_changes(item)
-            return data
+            return self.server.websocket_wait(timeout)
         else:
             raise SlackNotConnected
 
@@ -169,7 +356,7 @@ class SlackClient(object):
 
         Stores new channels when joining a group (Multi-party DM), IM (DM) or channel.
 
-        Stores user data on a team join event.
+        Stores user data on a team join event and refreshes it on a user change event.
         '''
         if "type" in data.keys():
             if data["type"] in ('channel_created', 'group_joined'):
@@ -181,6 +368,10 @@ class SlackClient(object):
             if data["type"] == "team_join":
                 user = data["user"]
                 self.server.parse_user_data([user])
+            if data["type"] == "user_change":
+                user = data["user"]
+                self.server.user_cache.invalidate(user["id"])
+                self.server.parse_user_data([user])
             pass
 
 
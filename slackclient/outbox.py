@@ -0,0 +1,192 @@
+import collections
+import logging
+import threading
+import time
+
+
+class Outbox(object):
+    '''
+    Serializes websocket writes. Any thread may `put` a message, a single writer thread
+    sends them in order, so concurrent senders never interleave frames on the socket.
+
+    Chat messages are queued per channel and sent through a token bucket, Slack allows
+    about one RTM message per second per channel. While a message waits for its turn,
+    following messages to the same channel (and thread) are merged into it, and text
+    longer than `MAX_LENGTH` is split into several messages. Other frames, like pings,
+    skip the queues.
+
+    A message whose send raises one of `retry_on` is kept at the head of its queue and
+    sent again after a backoff, it is dropped after `RETRIES` failed attempts. Other
+    errors drop it right away, sending it again would fail the same way. Reconnecting
+    is up to `send`.
+
+    Init:
+        :Args:
+            send (callable): writes one message to the websocket, called on the writer thread
+            rate (float): messages per second per channel, 0 disables the limit
+            retry_on (tuple): exception types worth another attempt
+    '''
+    BURST = 3
+    MAX_LENGTH = 4000
+    RETRIES = 3
+
+    def __init__(self, send, rate=1.0, retry_on=()):
+        self.send = send
+        self.rate = rate
+        self.retry_on = retry_on
+        self.control = collections.deque()
+        self.channels = collections.OrderedDict()
+        self.buckets = {}
+        self.thread = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.counters = {"sent": 0, "merged": 0, "split": 0, "retried": 0, "dropped": 0}
+
+    def put(self, data):
+        self._ensure_writer()
+        with self.condition:
+            if data.get("type") == "message" and "channel" in data and isinstance(data.get("text"), str):
+                self._queue_message(data)
+            else:
+                self.control.append(Pending(data))
+            self.condition.notify()
+
+    def depth(self):
+        with self.lock:
+            return len(self.control) + sum(len(q) for q in self.channels.values())
+
+    def depth_by_channel(self):
+        with self.lock:
+            return dict((channel, len(q)) for channel, q in self.channels.items())
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _queue_message(self, data):
+        chunks = split_text(data["text"], self.MAX_LENGTH)
+        if len(chunks) > 1:
+            self.counters["split"] += len(chunks) - 1
+        pending = self.channels.setdefault(data["channel"], collections.deque())
+        for chunk in chunks:
+            message = dict(data, text=chunk)
+            last = pending[-1] if len(pending) > 0 else None
+            if last is not None and not last.sending and can_merge(last.data, message, self.MAX_LENGTH):
+                last.data["text"] += "\n" + chunk
+                self.counters["merged"] += 1
+            else:
+                pending.append(Pending(message))
+
+    def _ensure_writer(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="slack-outbox")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _next(self):
+        '''
+        Blocks until a frame may be sent, returns (queue it heads, frame)
+        '''
+        with self.condition:
+            while True:
+                if len(self.control) > 0:
+                    self.control[0].sending = True
+                    return self.control, self.control[0]
+                now = time.time()
+                wait = None
+                for channel, pending in self.channels.items():
+                    delay = self._take_token(channel, now)
+                    if delay == 0:
+                        #round robin, the channel goes to the back after each send
+                        self.channels.move_to_end(channel)
+                        pending[0].sending = True
+                        return pending, pending[0]
+                    wait = delay if wait is None else min(wait, delay)
+                self.condition.wait(wait)
+
+    def _take_token(self, channel, now):
+        if self.rate <= 0:
+            return 0
+        tokens, updated = self.buckets.get(channel, (self.BURST, now))
+        tokens = min(self.BURST, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[channel] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[channel] = (tokens - 1, now)
+        return 0
+
+    def _done(self, pending, item):
+        with self.lock:
+            pending.popleft()
+            if pending is not self.control and len(pending) == 0:
+                channel = item.data["channel"]
+                if self.channels.get(channel) is pending:
+                    del self.channels[channel]
+
+    def _run(self):
+        while True:
+            pending, item = self._next()
+            try:
+                self.send(item.data)
+                with self.lock:
+                    self.counters["sent"] += 1
+                self._done(pending, item)
+            except self.retry_on:
+                item.attempts += 1
+                item.sending = False
+                if item.attempts >= self.RETRIES:
+                    self._drop(pending, item)
+                    continue
+                logging.exception("Failed to send RTM message, retrying")
+                with self.lock:
+                    self.counters["retried"] += 1
+                time.sleep(min(60, 2 ** item.attempts))
+            except Exception:
+                self._drop(pending, item)
+
+    def _drop(self, pending, item):
+        logging.exception("Failed to send RTM message, dropping it")
+        with self.lock:
+            self.counters["dropped"] += 1
+        self._done(pending, item)
+
+
+class Pending(object):
+    def __init__(self, data):
+        self.data = data
+        self.attempts = 0
+        #set while the writer has it, so nothing is merged into a message being sent
+        self.sending = False
+
+
+def can_merge(queued, message, max_length):
+    if queued.get("thread_ts") != message.get("thread_ts") or queued.get("reply_broadcast") or message.get("reply_broadcast"):
+        return False
+    if set(queued.keys()) != set(message.keys()):
+        return False
+    return len(queued["text"]) + 1 + len(message["text"]) <= max_length
+
+
+def split_text(text, max_length):
+    '''
+    Splits `text` into parts of at most `max_length` characters, at line breaks where
+    possible. A ``` block cut in two is closed and reopened, so each part renders on its own.
+    '''
+    parts = []
+    reopen = ""
+    while len(reopen) + len(text) > max_length:
+        limit = max_length - len(reopen) - 3
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        part = reopen + text[:cut].rstrip("\r")
+        text = text[cut:].lstrip("\r\n") if text[cut:cut + 1] in ("\r", "\n") else text[cut:]
+        if part.count("```") % 2 == 1:
+            part += "```"
+            reopen = "```"
+        else:
+            reopen = ""
+        parts.append(part)
+    parts.append(reopen + text)
+    return parts
@@ -1,19 +1,24 @@
 from .channel import Channel
-from .exceptions import SlackClientError
+from .exceptions import ParseResponseError, SlackClientError
+from .outbox import Outbox
 from .slackrequest import SlackRequest
 from .user import User
+from .usercache import UserCache
 from .util import SearchList, SearchDict
 
 import json
 import logging
 import time
 import random
+import select
+import socket
 import ssl
+import threading
 
 from requests.packages.urllib3.util.url import parse_url
 from ssl import SSLError
 from websocket import WebSocket
-from websocket._exceptions import WebSocketConnectionClosedException
+from websocket._exceptions import WebSocketConnectionClosedException, WebSocketException
 
 
 class Server(object):
@@ -22,27 +27,31 @@ class Server(object):
 
 
     """
-    def __init__(self, token, connect=True, proxies=None):
+    def __init__(self, token, connect=True, proxies=None, user_cache_ttl=3600, base_url=None, message_rate=1.0, pool_size=10):
         # Slack client configs
         self.token = token
         self.proxies = proxies
-        self.api_requester = SlackRequest(proxies=proxies)
+        self.api_requester = SlackRequest(proxies=proxies, base_url=base_url, pool_size=pool_size)
 
         # Workspace metadata
         self.username = None
         self.domain = None
         self.login_data = None
         self.users = SearchDict()
+        self.user_cache = UserCache(user_cache_ttl)
         self.channels = SearchList()
 
         # RTM configs
         self.websocket = None
+        self.outbox = Outbox(self._send_now, message_rate, retry_on=(SlackConnectionError,))
         self.ws_url = None
         self.connected = False
+        # The reader and the outbox writer may both find the socket dead, only one reconnects
+        self.connect_lock = threading.RLock()
+        self.connection_id = 0
         self.auto_reconnect = False
         self.last_connected_at = 0
         self.reconnect_count = 0
-        self.rtm_connect_retries = 0
 
         # Connect to RTM on load
         if connect:
@@ -102,6 +111,11 @@ class Server(object):
 
         """
 
+        # The reader and the outbox writer must not replace the websocket under each other
+        with self.connect_lock:
+            self._rtm_connect(reconnect, timeout, use_rtm_start, **kwargs)
+
+    def _rtm_connect(self, reconnect, timeout, use_rtm_start, **kwargs):
         # rtm.start returns user and channel info, rtm.connect does not.
         connect_method = "rtm.start" if use_rtm_start else "rtm.connect"
 
@@ -132,16 +146,9 @@ class Server(object):
         reply = self.api_requester.do(self.token, connect_method, timeout=timeout, post_data=kwargs)
 
         if reply.status_code != 200:
-            if self.rtm_connect_retries < 5 and reply.status_code == 429:
-                self.rtm_connect_retries += 1
-                retry_after = int(reply.headers.get('retry-after', 120))
-                logging.debug("HTTP 429: Rate limited. Retrying in %d seconds", retry_after)
-                time.sleep(retry_after)
-                self.rtm_connect(reconnect=reconnect, timeout=timeout)
-            else:
-                raise SlackConnectionError("RTM connection attempt was rate limited 10 times.")
+            # Rate limiting was already waited out and retried by SlackRequest
+            raise SlackConnectionError("RTM connection attempt failed with HTTP %d" % reply.status_code, reply=reply)
         else:
-            self.rtm_connect_retries = 0
             login_data = reply.json()
             if login_data["ok"]:
                 self.ws_url = login_data['url']
@@ -178,11 +185,21 @@ class Server(object):
             #                                   http_proxy_host=proxy_host,
             #                                   http_proxy_port=proxy_port,
             #                                   http_proxy_auth=proxy_auth)
-            self.websocket = WebSocket(sslopt={"cert_reqs": ssl.CERT_NONE})
-            self.websocket.connect(ws_url,
-                                              http_proxy_host=proxy_host,
-                                              http_proxy_port=proxy_port,
-                                              http_proxy_auth=proxy_auth)
+            websocket = WebSocket(sslopt={"cert_reqs": ssl.CERT_NONE})
+            websocket.connect(ws_url,
+                              http_proxy_host=proxy_host,
+                              http_proxy_port=proxy_port,
+                              http_proxy_auth=proxy_auth)
+            with self.connect_lock:
+                old_websocket = self.websocket
+                self.websocket = websocket
+                self.connection_id += 1
+            if old_websocket is not None:
+                # Whoever still holds it gets an error and finds the new connection_id
+                try:
+                    old_websocket.close()
+                except Exception:
+                    pass
             self.connected = True
             self.last_connected_at = time.time()
             logging.debug("RTM connected")
@@ -217,17 +234,51 @@ class Server(object):
 
     def send_to_websocket(self, data):
         """
-        Send a JSON message directly to the websocket. See
+        Queue a JSON message for the websocket. Safe to call from any thread, messages are
+        written in order by the outbox's writer thread, rate limited per channel. See
         `RTM documentation <https://api.slack.com/rtm` for allowed types.
 
         :Args:
             data (dict) the key/values to send the websocket.
 
         """
+        self.outbox.put(data)
+
+    def _send_now(self, data):
+        # Raised before touching the socket, a message that can't be serialized is no reason to reconnect
+        message = json.dumps(data)
+        with self.connect_lock:
+            connection_id, websocket = self.connection_id, self.websocket
         try:
-            data = json.dumps(data)
-            self.websocket.send(data)
-        except Exception:
+            if websocket is None:
+                raise WebSocketConnectionClosedException("RTM websocket is not connected")
+            websocket.send(message)
+        except (socket.error, WebSocketException) as e:
+            try:
+                self.reconnect(connection_id)
+            except Exception as reconnect_error:
+                # rtm.start failing while the network is down must not make the message look undeliverable
+                raise SlackConnectionError("Unable to send due to closed RTM websocket: %s, reconnect failed: %s" % \
+                    (str(e), str(reconnect_error)))
+            raise SlackConnectionError("Unable to send due to closed RTM websocket: %s" % str(e))
+
+    def reconnect(self, connection_id):
+        """
+        Reopens the websocket after connection `connection_id` failed. The reader and the
+        outbox writer may both call it for the same failure, only the first one reconnects,
+        the other finds a newer connection and returns right away.
+
+        :Args:
+            connection_id (int) - `connection_id` of the websocket that failed
+
+        """
+        with self.connect_lock:
+            if self.connection_id != connection_id:
+                return
+            logging.debug("RTM disconnected")
+            self.connected = False
+            if not self.auto_reconnect:
+                raise SlackConnectionError("Unable to send due to closed RTM websocket")
             self.rtm_connect(reconnect=True)
 
     def rtm_send_message(self, channel, message, thread=None, reply_broadcast=None):
@@ -258,16 +309,60 @@ class Server(object):
     def ping(self):
         return self.send_to_websocket({"type": "ping"})
 
+    def websocket_wait(self, timeout=None):
+        """
+        Blocks until the websocket has data to read or `timeout` seconds pass.
+
+        :Args:
+            timeout (float or None) - maximum time to wait, None waits forever
+
+        :Returns:
+            True if a read is likely to return data, False on timeout
+        """
+        sock = self.websocket.sock if self.websocket is not None else None
+        if sock is None:
+            # Disconnected, don't spin: wait a little, then let the reader reconnect
+            time.sleep(min(timeout, 1) if timeout is not None else 1)
+            return self.websocket is not None
+
+        # Bytes already decrypted by the SSL layer are invisible to select()
+        pending = getattr(sock, "pending", None)
+        if pending is not None and pending() > 0:
+            return True
+
+        try:
+            readable, _, _ = select.select([sock], [], [], timeout)
+        except (ValueError, OSError):
+            # Socket was closed under us, let the reader handle reconnection
+            return True
+        return len(readable) > 0
+
     def websocket_safe_read(self):
         """
-        Returns data if available, otherwise ''. Newlines indicate multiple
-        messages
+        Returns data if available, otherwise ''. Reads a single frame, see `websocket_frames`
         """
+        for frame in self.websocket_frames(1):
+            return frame
+        return ''
 
-        data = ""
-        while True:
+    def websocket_frames(self, limit=None):
+        """
+        Yields the payload of each websocket frame that can be read without blocking, one
+        RTM event per frame.
+
+        :Args:
+            limit (int or None) - stop after this many frames, so a burst of events can't
+            keep the caller from its other work. None reads until no data is left
+
+        """
+        with self.connect_lock:
+            connection_id, websocket = self.connection_id, self.websocket
+        if websocket is None:
+            return
+        count = 0
+        while limit is None or count < limit:
             try:
-                data += "{0}\n".format(self.websocket.recv())
+                frame = websocket.recv()
             except SSLError as e:
                 if e.errno == 2:
                     # errno 2 occurs when trying to read or write data, but more
@@ -276,19 +371,23 @@ class Server(object):
                     #
                     # Python 2.7.9+ and Python 3.3+ give this its own exception,
                     # SSLWantReadError
-                    return ''
+                    return
                 raise
-            except WebSocketConnectionClosedException as e:
-                logging.debug("RTM disconnected")
-                self.connected = False
-                if self.auto_reconnect:
-                    self.rtm_connect(reconnect=True)
-                else:
-                    raise SlackConnectionError("Unable to send due to closed RTM websocket")
-            return data.rstrip()
+            except BlockingIOError:
+                # Plain ws:// sockets report an empty non-blocking read this way
+                return
+            except WebSocketConnectionClosedException:
+                self.reconnect(connection_id)
+                return
+            # Control frames (pong) come back as empty payloads
+            if frame:
+                yield frame
+            count += 1
 
     def attach_user(self, name, user_id, real_name, tz, email):
-        self.users.update({user_id: User(self, name, user_id, real_name, tz, email)})
+        user = User(self, name, user_id, real_name, tz, email)
+        self.users.update({user_id: user})
+        self.user_cache.put(user)
 
     def attach_channel(self, name, channel_id, members=None):
         if members is None:
@@ -341,7 +440,11 @@ class Server(object):
             See here for more information on responses: https://api.slack.com/web
         """
         response = self.api_requester.do(self.token, method, kwargs, timeout=timeout)
-        response_json = json.loads(response.text)
+        try:
+            response_json = json.loads(response.text)
+        except ValueError as json_decode_error:
+            # Proxies and load balancers answer 5xx with html
+            raise ParseResponseError(response.text, json_decode_error)
         response_json["headers"] = dict(response.headers)
         return json.dumps(response_json)
 
@@ -1,13 +1,34 @@
 import requests
 import json
+import logging
 import six
 import sys
 import platform
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from .version import __version__
 
 
 class SlackRequest(object):
-    def __init__(self, proxies=None):
+    """
+    Sends Web API requests over a pooled, keep-alive `requests.Session`, so consecutive calls
+    reuse their TCP and TLS connection.
+
+    Requests are sent again, up to `retries` attempts each, in two cases where Slack can't
+    have acted on them: they could not connect (after a short backoff), or they were answered
+    with HTTP 429 (after their Retry-After). A connection lost after sending and timeouts go
+    back to the caller, repeating a chat.postMessage there could post it twice.
+
+    Args:
+        proxies (dict): proxies for every request
+        base_url (str): Web API root to use instead of https://slack.com/api/
+        pool_size (int): connections kept open per host
+        retries (int): attempts per request, for each of the two cases
+    """
+    def __init__(self, proxies=None, base_url=None, pool_size=10, retries=3):
 
         # __name__ returns 'slackclient.slackrequest', we only want 'slackclient'
         client_name = __name__.split('.')[0]
@@ -21,9 +42,26 @@ class SlackRequest(object):
         }
 
         self.custom_user_agent = None
+        self.user_agent = None
         self.proxies = proxies
+        # Overrides 'https://<domain>/api/', e.g. to talk to a local stand-in of the Web API
+        self.base_url = base_url
+        self.retries = retries
+
+        self.session = requests.Session()
+        # Connect errors only: a POST that reached the server must not be replayed
+        max_retries = Retry(total=None, connect=retries - 1, read=0, status=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def get_user_agent(self):
+        # Built once, append_user_agent clears it
+        if self.user_agent is None:
+            self.user_agent = self._build_user_agent()
+        return self.user_agent
+
+    def _build_user_agent(self):
         # Check for custom user-agent and append if found
         if self.custom_user_agent:
             custom_ua_list = ["/".join(client_info) for client_info in self.custom_user_agent]
@@ -43,6 +81,7 @@ class SlackRequest(object):
             self.custom_user_agent.append([name.replace("/", ":"), version.replace("/", ":")])
         else:
             self.custom_user_agent = [[name, version]]
+        self.user_agent = None
 
     def do(self, token, request="?", post_data=None, domain="slack.com", timeout=None):
         """
@@ -58,7 +97,10 @@ class SlackRequest(object):
                 than slack.com
         """
 
-        url = 'https://{0}/api/{1}'.format(domain, request)
+        if self.base_url is not None:
+            url = self.base_url + request
+        else:
+            url = 'https://{0}/api/{1}'.format(domain, request)
 
         # Override token header if `token` is passed in post_data
         if post_data is not None and "token" in post_data:
@@ -94,12 +136,108 @@ class SlackRequest(object):
             if isinstance(v, (list, dict)):
                 post_data[k] = json.dumps(v)
 
-        # Submit the request
-        return requests.post(
+        # Submit the request, a file object can't be sent twice
+        attempts = self.retries if files is None else 1
+        for attempt in range(attempts):
+            response = self.session.post(
+                url,
+                headers=headers,
+                data=post_data,
+                files=files,
+                timeout=timeout,
+                proxies=self.proxies
+            )
+            if response.status_code != 429 or attempt == attempts - 1:
+                return response
+            delay = parse_retry_after(response.headers.get('retry-after'), 1)
+            logging.debug("HTTP 429: %s rate limited, retrying in %d seconds", request, delay)
+            time.sleep(delay)
+
+    def post_file(self, url, file_obj, length, progress=None, timeout=None, throttle=None):
+        """
+        Stream a file as the raw body of a POST request, e.g. to an upload URL returned by
+        `files.getUploadURLExternal`. The file is read in small blocks, never as a whole.
+
+        Args:
+            url (str): where to send the file
+            file_obj (file): binary file object positioned at the start of the data
+            length (int): number of bytes to send
+            progress (callable): called with (bytes_sent, length) as the upload goes
+            timeout (float): stop waiting for a response after a given number of seconds
+            throttle (Throttle): bandwidth limit, may be shared between uploads
+        """
+        headers = {
+            'user-agent': self.get_user_agent(),
+            'Content-Type': 'application/octet-stream'
+        }
+        return self.session.post(
             url,
             headers=headers,
-            data=post_data,
-            files=files,
+            data=UploadStream(file_obj, length, progress, throttle),
             timeout=timeout,
             proxies=self.proxies
         )
+
+
+def parse_retry_after(value, default):
+    """
+    Seconds to wait according to a Retry-After header, which holds either a number of seconds
+    or an HTTP date. Returns `default` when it is missing or can't be parsed.
+    """
+    if value is None:
+        return default
+    try:
+        return max(0, int(float(value)))
+    except ValueError:
+        pass
+    try:
+        return max(0, int(parsedate_to_datetime(value).timestamp() - time.time()))
+    except (TypeError, ValueError, IndexError):
+        return default
+
+
+class UploadStream(object):
+    """
+    File wrapper that reports progress. Having `read` and `__len__` but no `__iter__` makes
+    requests send it with a Content-Length header and read it block by block.
+    """
+    def __init__(self, file_obj, length, progress=None, throttle=None):
+        self.file_obj = file_obj
+        self.length = length
+        self.progress = progress
+        self.throttle = throttle
+        self.sent = 0
+
+    def __len__(self):
+        return self.length - self.sent
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.sent
+        data = self.file_obj.read(min(size, self.length - self.sent))
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+        self.sent += len(data)
+        if self.progress is not None and len(data) > 0:
+            self.progress(self.sent, self.length)
+        return data
+
+
+class Throttle(object):
+    """
+    Bandwidth limit shared by any number of streams: every block waits for its own slot,
+    so together they never go faster than `bytes_per_second`.
+    """
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_slot)
+            self.next_slot = start + size / self.bytes_per_second
+            delay = self.next_slot - now
+        if delay > 0:
+            time.sleep(delay)
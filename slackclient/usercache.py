@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class UserCache(object):
+    '''
+    Time limited cache of User objects keyed by user id.
+
+    Entries are filled from `rtm.start`, `team_join`/`user_change` events and `users.info`
+    replies, and are dropped after `ttl` seconds or when the user changes.
+
+    Init:
+        :Args:
+            ttl (float): seconds an entry stays valid, 0 keeps entries forever
+    '''
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        '''
+        Returns the cached User or None on a miss (unknown or expired id)
+        '''
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                user, stamp = entry
+                if self.ttl <= 0 or time.time() - stamp < self.ttl:
+                    self.hits += 1
+                    return user
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user):
+        with self._lock:
+            self._entries[user.id] = (user, time.time())
+
+    def invalidate(self, user_id=None):
+        '''
+        Drops one user, or every user if `user_id` is None
+        '''
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -1,4 +1,9 @@
+from contextlib import closing
+
 import os
+import sqlite3
+import threading
+import config
 import yaml
 
 try:
@@ -7,7 +12,11 @@ except ImportError:
     from yaml import Loader, Dumper
 
 class Project:
-    def __init__(self, url, keystore_filename, keystore_pwd, key, key_pwd, name=""):
+    #class level defaults for projects saved before these fields existed
+    fetch_depth = 0
+    fetch_filter = ""
+
+    def __init__(self, url, keystore_filename, keystore_pwd, key, key_pwd, name="", fetch_depth=0, fetch_filter=""):
         if name is None or len(name) == 0:
             self.name = self.get_name_from_url(url)
         else:
@@ -17,6 +26,8 @@ class Project:
         self.keystore_pwd = keystore_pwd
         self.key = key
         self.key_pwd = key_pwd
+        self.fetch_depth = fetch_depth
+        self.fetch_filter = fetch_filter
 
     def __str__(self):
         return "%s: %s" % (self.name, self.url)
@@ -26,49 +37,250 @@ class Project:
         return os.path.splitext(splitted[-1])[0]
 
 
+class ProjectIndex:
+    """Lookup of projects by exact url/name and by substring through a trigram index, kept in sync by Store"""
+    def __init__(self, projects=()):
+        self.by_url = {}
+        self.by_name = {}
+        self.trigrams = {}
+        self.keys = {}
+        self.indexed_urls = {}
+        for project in projects:
+            self.add(project)
+
+    def add(self, project):
+        url = project.url.lower()
+        name = project.name.lower()
+        self.keys[url] = (name, project)
+        self.indexed_urls[id(project)] = url
+        self.by_url[url] = project
+        self.by_name.setdefault(name, []).append(project)
+        for trigram in get_trigrams(name) | get_trigrams(url):
+            self.trigrams.setdefault(trigram, set()).add(url)
+
+    def remove(self, project):
+        #look up the key it was indexed under, alter may have changed the url since
+        url = self.indexed_urls.pop(id(project), None)
+        if url is None:
+            return
+        name, indexed = self.keys.pop(url)
+        del self.by_url[url]
+        self.by_name[name].remove(indexed)
+        if len(self.by_name[name]) == 0:
+            del self.by_name[name]
+        for trigram in get_trigrams(name) | get_trigrams(url):
+            postings = self.trigrams[trigram]
+            postings.discard(url)
+            if len(postings) == 0:
+                del self.trigrams[trigram]
+
+    def update(self, project):
+        #the name or url may have changed, so reindex it from scratch
+        self.remove(project)
+        self.add(project)
+
+    def find_substring(self, query):
+        """Returns projects whose name or url contains `query`"""
+        if len(query) < 3:
+            return [p for url, (name, p) in self.keys.items() if query in name or query in url]
+        candidates = None
+        for trigram in get_trigrams(query):
+            postings = self.trigrams.get(trigram)
+            if postings is None:
+                return []
+            candidates = postings if candidates is None else candidates & postings
+        result = []
+        for url in candidates:
+            name, project = self.keys[url]
+            if query in name or query in url:
+                result.append(project)
+        return result
+
+    def rank(self, query, projects):
+        """Orders matches best first: name prefix, then name, then url matches, shorter names first"""
+        def score(project):
+            name = project.name.lower()
+            return (not name.startswith(query), query not in name, len(name) - len(query), name)
+        return sorted(projects, key=score)
+
+    def find_similar(self, query, limit=3, threshold=0.3):
+        """Returns projects whose name shares enough trigrams with `query`, most similar first"""
+        query_trigrams = get_trigrams(query)
+        if len(query_trigrams) == 0:
+            return []
+        counts = {}
+        for trigram in query_trigrams:
+            for url in self.trigrams.get(trigram, ()):
+                counts[url] = counts.get(url, 0) + 1
+        scored = []
+        for url, shared in counts.items():
+            name, project = self.keys[url]
+            similarity = float(shared) / len(query_trigrams | get_trigrams(name))
+            if similarity >= threshold:
+                scored.append((-similarity, name, project))
+        scored.sort(key=lambda s: (s[0], s[1]))
+        return [project for similarity, name, project in scored[:limit]]
+
+
+def get_trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class YamlBackend:
+    """Projects as a YAML list in one file, replaced atomically on every change"""
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, "r") as f:
+            return yaml.load(f, Loader=Loader) or []
+
+    def save_all(self, projects):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            yaml.dump(list(projects), f, allow_unicode=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def upsert(self, project, projects):
+        self.save_all(projects)
+
+    def delete(self, project, projects):
+        self.save_all(projects)
+
+
+class SqliteBackend:
+    """Projects as rows of a SQLite database in WAL mode, every change is a transaction of its own"""
+    COLUMNS = ("url", "keystore_filename", "keystore_pwd", "key", "key_pwd", "name", "fetch_depth", "fetch_filter")
+
+    def __init__(self, path, migrate_from=None):
+        self.path = path
+        with closing(self.connect()) as db, db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS projects (
+                url_key TEXT PRIMARY KEY,
+                name_key TEXT NOT NULL,
+                url TEXT NOT NULL,
+                keystore_filename TEXT NOT NULL,
+                keystore_pwd TEXT NOT NULL,
+                key TEXT NOT NULL,
+                key_pwd TEXT NOT NULL,
+                name TEXT NOT NULL,
+                fetch_depth INTEGER NOT NULL DEFAULT 0,
+                fetch_filter TEXT NOT NULL DEFAULT ''
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS projects_name ON projects (name_key)")
+        if migrate_from is not None:
+            self.migrate(migrate_from)
+
+    def connect(self):
+        #the connection only commits as a context manager, callers close it with closing()
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def migrate(self, yaml_path):
+        """Imports projects.yml once, then renames it so it isn't imported again"""
+        if not os.path.isfile(yaml_path):
+            return
+        projects = YamlBackend(yaml_path).load()
+        with closing(self.connect()) as db, db:
+            for project in projects:
+                db.execute("INSERT OR IGNORE INTO projects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._row(project))
+        os.replace(yaml_path, yaml_path + ".migrated")
+        print("Migrated %d projects from %s to %s" % (len(projects), yaml_path, self.path))
+
+    def _row(self, project):
+        return (project.url.lower(), project.name.lower()) + tuple(getattr(project, c) for c in self.COLUMNS)
+
+    def _project(self, row):
+        return Project(*row)
+
+    def load(self):
+        with closing(self.connect()) as db, db:
+            rows = db.execute("SELECT %s FROM projects ORDER BY rowid" % ", ".join(self.COLUMNS)).fetchall()
+        return [self._project(row) for row in rows]
+
+    def upsert(self, project, projects=None):
+        with closing(self.connect()) as db, db:
+            db.execute("UPDATE projects SET name_key = ?, keystore_filename = ?, keystore_pwd = ?, key = ?, key_pwd = ?, name = ?, " \
+                "fetch_depth = ?, fetch_filter = ? WHERE url_key = ?", (project.name.lower(), project.keystore_filename, project.keystore_pwd, \
+                project.key, project.key_pwd, project.name, project.fetch_depth, project.fetch_filter, project.url.lower()))
+            db.execute("INSERT OR IGNORE INTO projects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._row(project))
+
+    def delete(self, project, projects=None):
+        with closing(self.connect()) as db, db:
+            db.execute("DELETE FROM projects WHERE url_key = ?", (project.url.lower(),))
+
+
 class Store:
-    def __init__(self):
+    def __init__(self, backend=None):
+        if backend is None:
+            if config.STORE_BACKEND == "yaml":
+                backend = YamlBackend("./projects.yml")
+            else:
+                backend = SqliteBackend("./projects.db", migrate_from="./projects.yml")
+        self.backend = backend
+        self.lock = threading.RLock()
         try:
-            with open("./projects.yml", "r") as f:
-                self._data = yaml.load(f, Loader=Loader)
-            self.save()
+            self._data = backend.load()
         except Exception as ex:
-            print("Failed to load projects.yml! " + str(ex))
-            self._data = {}
-            self.save()
+            print("Failed to load projects! " + str(ex))
+            self._data = []
+        self.index = ProjectIndex(self._data)
 
     def get_data(self):
-        return self._data
+        with self.lock:
+            return list(self._data)
 
     def is_url_exists(self, url):
-        for p in self._data:
-            if url.lower() == p.url.lower():
-                return True
-        return False
+        with self.lock:
+            return url.lower() in self.index.by_url
 
     def search(self, sentence):
-        projects = []
-        for value in self._data:
-            if value.name.lower().find(sentence.lower()) >= 0 and value not in projects:
-                projects.append(value)
-            if value.url.lower().find(sentence.lower()) >= 0 and value not in projects:
-                projects.append(value)
+        """Finds a project by url, exact name or a unique part of its name or url"""
+        query = sentence.strip().lower()
+        with self.lock:
+            if query in self.index.by_url:
+                return self.index.by_url[query]
+            #an exact name wins over longer names containing it
+            exact = self.index.by_name.get(query, [])
+            if len(exact) == 1:
+                return exact[0]
 
-        if len(projects) > 1:
-            raise Exception("Ambiguous name detected: " + ", ".join([str(p) for p in projects]))
-        if len(projects) == 0:
-            raise Exception("Project not found")
+            projects = self.index.find_substring(query)
+            if len(projects) == 1:
+                return projects[0]
+            if len(projects) > 1:
+                projects = self.index.rank(query, projects)
+                raise Exception("Ambiguous name detected: " + ", ".join([str(p) for p in projects]))
 
-        return projects[0]
+            similar = self.index.find_similar(query)
+        if len(similar) > 0:
+            raise Exception("Project not found. Did you mean: " + ", ".join([p.name for p in similar]))
+        raise Exception("Project not found")
 
     def remove_project(self, project):
-        self._data.remove(project)
-        self.save()
+        with self.lock:
+            self._data.remove(project)
+            self.index.remove(project)
+            self.backend.delete(project, self._data)
 
-    def save(self):
-        with open("./projects.yml", "w") as f:
-            yaml.dump(self._data, f, allow_unicode=True)
+    def update_project(self, project):
+        """Persists changes made to a project's fields"""
+        with self.lock:
+            self.index.update(project)
+            self.backend.upsert(project, self._data)
 
     def add_project(self, project):
-        self._data.append(project)
-        self.save()
\ No newline at end of file
+        with self.lock:
+            self._data.append(project)
+            try:
+                self.backend.upsert(project, self._data)
+            except Exception:
+                self._data.remove(project)
+                raise
+            self.index.add(project)
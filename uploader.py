@@ -0,0 +1,30 @@
+import threading
+import traceback
+import queue
+
+
+class UploadWorker:
+    """Delivers finished builds from its own queue on background threads, so neither pipelines nor the RTM loop wait for uploads"""
+    def __init__(self, concurrency=1):
+        self.queue = queue.Queue()
+        self.threads = []
+        for i in range(max(1, concurrency)):
+            thread = threading.Thread(target=self._run, name="upload-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, action, *args):
+        self.queue.put((action, args))
+
+    def get_pending(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            action, args = self.queue.get()
+            try:
+                action(*args)
+            except Exception as ex:
+                print("Failed to deliver build: %s" % str(ex))
+                traceback.print_exc()